@@ -0,0 +1,199 @@
+"""
+MIT License
+
+Copyright (c) 2024 Raphael Maschinsen
+raphaelmaschinsen@gmail.com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import main
+
+FILE_TYPES = [".h", ".cpp", ".glsl", "CMakeLists.txt"]
+FILES_PER_FOLDER = 50
+FOLDERS_PER_MODULE = 10
+
+
+SYNTHETIC_HEADER = "// {path}\n#pragma once\n\nclass {name} {{\npublic:\n    int compute(int value) const;\n}};\n"
+SYNTHETIC_SOURCE = "// {path}\n#include \"{name}.h\"\n\nint {name}::compute(int value) const {{\n    return value * {index};\n}}\n"
+
+
+def write_file(path: str, with_content: bool):
+    """Creates a synthetic file, either empty or with a few lines of plausible code that is unique to the file."""
+    with open(path, "w", encoding="utf-8") as file:
+        if with_content:
+            name, extension = os.path.splitext(os.path.basename(path))
+            template = SYNTHETIC_SOURCE if extension == ".cpp" else SYNTHETIC_HEADER
+            file.write(template.format(path=path, name=name, index=len(path)))
+
+
+def create_synthetic_project(root_dir: str, file_count: int, with_content: bool = False):
+    """Creates a C++ project with about `file_count` source files plus a build folder that should be excluded.
+
+    Every folder holds header/source pairs, a few unpaired files and a vertex/fragment shader pair, and every
+    module has a CMakeLists.txt.
+    """
+    src_dir = os.path.join(root_dir, "src")
+    created = 0
+    folder_index = 0
+    while created < file_count:
+        module = folder_index // FOLDERS_PER_MODULE
+        module_dir = os.path.join(src_dir, f"module{module}")
+        folder = os.path.join(module_dir, f"part{folder_index % FOLDERS_PER_MODULE}")
+        os.makedirs(folder, exist_ok=True)
+        if folder_index % FOLDERS_PER_MODULE == 0:
+            write_file(os.path.join(module_dir, "CMakeLists.txt"), with_content)
+            created += 1
+        names = [f"class{i}.h" if i % 2 == 0 else f"class{i - 1}.cpp" for i in range(FILES_PER_FOLDER - 4)]
+        names += ["helper.h", "standalone.cpp", "blur_vertex.glsl", "blur_fragment.glsl"]
+        for name in names[:file_count - created]:
+            write_file(os.path.join(folder, name), with_content)
+            created += 1
+        folder_index += 1
+
+    # Build output that the exclude patterns should skip without descending into it
+    build_dir = os.path.join(root_dir, "build", "generated")
+    os.makedirs(build_dir)
+    for i in range(max(1, file_count // 10)):
+        open(os.path.join(build_dir, f"generated{i}.cpp"), "w").close()
+
+
+def benchmark_scan(file_count: int) -> Tuple[int, int, float, float]:
+    """Times list_files and the pairing of every folder on a synthetic project with `file_count` files."""
+    with tempfile.TemporaryDirectory() as root_dir:
+        create_synthetic_project(root_dir, file_count)
+        ignore_rules = main.IgnoreRules(["build/"])
+        start = time.perf_counter()
+        project_structure = main.list_files(root_dir, FILE_TYPES, [root_dir], FILE_TYPES, ignore_rules)
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for files in project_structure.values():
+            main.pair_header_and_source_files(files)
+        pairing_time = time.perf_counter() - start
+    found = sum(len(files) for files in project_structure.values())
+    return found, len(project_structure), scan_time, pairing_time
+
+
+def run_scan_benchmark(sizes: List[int]):
+    print(f"{'files':>8} {'folders':>8} {'scan [s]':>10} {'pairing [s]':>12} {'files/s':>10}")
+    for size in sizes:
+        found, folder_count, scan_time, pairing_time = benchmark_scan(size)
+        total = scan_time + pairing_time
+        print(f"{found:>8} {folder_count:>8} {scan_time:>10.3f} {pairing_time:>12.3f} {found / total:>10.0f}")
+
+
+def benchmark_pipeline(root_dir: str, results_file: str, latency: float, concurrency: int,
+                       dedup: bool = True) -> Tuple[float, Dict[str, Any]]:
+    """Runs the whole pipeline with the fake backend and returns the wall time and the statistics of the run."""
+    args = main.parse_args([
+        root_dir, root_dir,
+        "--backend", "fake", "--fake-latency", str(latency),
+        "--max-concurrency", str(concurrency), "--requests-per-minute", "0", "--tokens-per-minute", "0",
+        "--results-file", results_file, "--exclude", "build/",
+    ] + ([] if dedup else ["--no-dedup"]))
+    start = time.perf_counter()
+    stats = main.run(args)
+    wall_time = time.perf_counter() - start
+    return wall_time, stats
+
+
+def run_pipeline_benchmark(sizes: List[int], latency: float, concurrency: int, dedup: bool = True):
+    """Benchmarks a cold run (empty cache) and a warm run (everything cached) per project size."""
+    print(f"{'components':>10} {'run':>5} {'wall [s]':>9} {'requests':>9} {'req/s':>8} {'cache hits':>10} "
+          f"{'deduped':>8} {'input tok':>10} {'output tok':>10}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as root_dir:
+            # Most folders hold header/source pairs, so two files make about one component
+            create_synthetic_project(root_dir, size * 2, with_content=True)
+            results_file = os.path.join(root_dir, "intermediate_results.jsonl")
+            for run_name in ("cold", "warm"):
+                wall_time, stats = benchmark_pipeline(root_dir, results_file, latency, concurrency, dedup)
+                deduplicated = stats["requests_avoided_by_dedup"]
+                components = stats["cache_hits"] + stats["cache_misses"] + deduplicated
+                print(f"{components:>10} {run_name:>5} {wall_time:>9.2f} {stats['requests']:>9} "
+                      f"{stats['requests'] / wall_time:>8.1f} {stats['cache_hit_rate']:>10.1%} {deduplicated:>8} "
+                      f"{stats['prompt_tokens']:>10} {stats['completion_tokens']:>10}")
+
+
+def benchmark_preprocessing(root_dir: str, max_body_tokens: int) -> Tuple[int, int, int, float]:
+    """Preprocesses every source file below `root_dir` and returns the file count, the tokens before and after and the time."""
+    project_structure = main.list_files(root_dir, FILE_TYPES, [root_dir], FILE_TYPES)
+    main.configure_preprocessing(True, max_body_tokens)
+    file_count = tokens_before = tokens_after = 0
+    elapsed = 0.0
+    for files in project_structure.values():
+        for file_path in files:
+            try:
+                content = main.read_file(file_path)
+            except (OSError, UnicodeDecodeError):
+                continue
+            start = time.perf_counter()
+            preprocessed = main.preprocess_source(os.path.basename(file_path), content)
+            elapsed += time.perf_counter() - start
+            file_count += 1
+            tokens_before += main.estimate_tokens(content)
+            tokens_after += main.estimate_tokens(preprocessed)
+    return file_count, tokens_before, tokens_after, elapsed
+
+
+def run_preprocessing_benchmark(root_dir: str, budgets: List[int]):
+    print(f"{'body tokens':>11} {'files':>7} {'tokens before':>14} {'tokens after':>13} {'saved':>7} {'time [s]':>9}")
+    for budget in budgets:
+        file_count, tokens_before, tokens_after, elapsed = benchmark_preprocessing(root_dir, budget)
+        saved = 1 - tokens_after / tokens_before if tokens_before else 0.0
+        print(f"{budget:>11} {file_count:>7} {tokens_before:>14} {tokens_after:>13} {saved:>7.1%} {elapsed:>9.2f}")
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmarks for AutoDoc.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    scan_parser = subparsers.add_parser("scan", help="time file discovery and pairing on synthetic trees")
+    scan_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                             help="number of source files of the synthetic trees")
+    pipeline_parser = subparsers.add_parser("pipeline", help="run the whole pipeline with the fake backend")
+    pipeline_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000],
+                                 help="approximate number of components of the synthetic projects")
+    pipeline_parser.add_argument("--latency", type=float, default=0.02, help="seconds each fake request takes")
+    pipeline_parser.add_argument("--concurrency", type=int, default=main.MAX_CONCURRENT_REQUESTS,
+                                 help="maximum number of requests in flight")
+    pipeline_parser.add_argument("--no-dedup", action="store_true",
+                                 help="summarize every component (the synthetic components are near-duplicates)")
+    preprocess_parser = subparsers.add_parser("preprocess", help="measure how much preprocessing shrinks a real project")
+    preprocess_parser.add_argument("root_dir", help="project whose source files are preprocessed")
+    preprocess_parser.add_argument("--max-body-tokens", type=int, nargs="+", default=[0, 50, 100, 200],
+                                   help="body budgets to compare (0 only removes banners and whitespace)")
+    args = parser.parse_args()
+
+    if args.benchmark == "scan":
+        run_scan_benchmark(args.sizes)
+    elif args.benchmark == "pipeline":
+        run_pipeline_benchmark(args.sizes, args.latency, args.concurrency, not args.no_dedup)
+    elif args.benchmark == "preprocess":
+        run_preprocessing_benchmark(args.root_dir, args.max_body_tokens)
+
+
+if __name__ == "__main__":
+    main_benchmark()
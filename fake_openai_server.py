@@ -0,0 +1,201 @@
+"""
+MIT License
+
+Copyright (c) 2024 Raphael Maschinsen
+raphaelmaschinsen@gmail.com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+from main import FakeBackend, estimate_tokens
+
+# A stand-in for the parts of the OpenAI API that AutoDoc uses: chat completions, files and batches.
+# Run it and point AutoDoc at it with OPENAI_BASE_URL=http://localhost:8000/v1
+
+
+def fake_completion(body: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds a chat completion response object for a request body."""
+    content = FakeBackend.fake_content(body.get("messages", []))
+    prompt_tokens = sum(estimate_tokens(message["content"]) for message in body.get("messages", []))
+    completion_tokens = estimate_tokens(content)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+class FakeOpenAIState:
+    """Files and batches held in memory."""
+
+    def __init__(self, batch_delay: float):
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        file_object = {"id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content),
+                       "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[file_object["id"]] = (file_object, content)
+        return file_object
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> Dict[str, Any]:
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": endpoint, "errors": None,
+                 "input_file_id": input_file_id, "completion_window": completion_window, "status": "in_progress",
+                 "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        return batch
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        """Returns a batch, processing its input file once the configured delay has passed."""
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] != "in_progress" or time.time() - batch["created_at"] < self.batch_delay:
+                return batch
+            _, content = self.files[batch["input_file_id"]]
+        outputs, errors = [], []
+        for line in content.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if request.get("url") != "/v1/chat/completions":
+                errors.append({"id": uuid.uuid4().hex, "custom_id": request.get("custom_id"), "response": None,
+                               "error": {"code": "invalid_url", "message": "Unsupported url"}})
+                continue
+            outputs.append({"id": uuid.uuid4().hex, "custom_id": request["custom_id"], "error": None,
+                            "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                         "body": fake_completion(request["body"])}})
+        output_file = self.add_file("".join(json.dumps(o) + "\n" for o in outputs).encode("utf-8"),
+                                    f"{batch_id}_output.jsonl", "batch_output")
+        error_file = self.add_file("".join(json.dumps(e) + "\n" for e in errors).encode("utf-8"),
+                                   f"{batch_id}_errors.jsonl", "batch_output") if errors else None
+        with self.lock:
+            batch.update(status="completed", completed_at=int(time.time()), output_file_id=output_file["id"],
+                         error_file_id=error_file["id"] if error_file else None,
+                         request_counts={"total": len(outputs) + len(errors), "completed": len(outputs),
+                                         "failed": len(errors)})
+            return batch
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    state: FakeOpenAIState = None
+    latency = 0.0
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send_json(self, data: Any, status: int = 200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, 404)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == "/v1/chat/completions":
+            time.sleep(self.latency)
+            self.send_json(fake_completion(json.loads(body)))
+        elif self.path == "/v1/files":
+            message = BytesParser(policy=default_policy).parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode("latin-1") + b"\r\n\r\n" + body)
+            fields = {}
+            for part in message.iter_parts():
+                fields[part.get_param("name", header="content-disposition")] = (
+                    part.get_filename(), part.get_payload(decode=True))
+            filename, content = fields["file"]
+            self.send_json(self.state.add_file(content, filename or "upload.jsonl", fields["purpose"][1].decode()))
+        elif self.path == "/v1/batches":
+            request = json.loads(body)
+            self.send_json(self.state.create_batch(request["input_file_id"], request["endpoint"],
+                                                   request["completion_window"]))
+        else:
+            self.send_not_found()
+
+    def do_GET(self):
+        batch_match = re.fullmatch(r"/v1/batches/([\w-]+)", self.path)
+        content_match = re.fullmatch(r"/v1/files/([\w-]+)/content", self.path)
+        if batch_match and batch_match.group(1) in self.state.batches:
+            self.send_json(self.state.retrieve_batch(batch_match.group(1)))
+        elif content_match and content_match.group(1) in self.state.files:
+            _, content = self.state.files[content_match.group(1)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_not_found()
+
+
+def create_server(port: int = 8000, batch_delay: float = 0.0, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Creates the fake server. Batches complete `batch_delay` seconds after they were created."""
+    handler = type("Handler", (FakeOpenAIHandler,), {"state": FakeOpenAIState(batch_delay), "latency": latency})
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completion, file and batch API.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="seconds until a batch is completed")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each chat completion takes")
+    args = parser.parse_args()
+
+    server = create_server(args.port, args.batch_delay, args.latency)
+    print(f"Fake OpenAI API listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,78 +23,1203 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import argparse
+import cProfile
+import ctypes
+import ctypes.util
+import difflib
+import hashlib
+import io
 import json
+import logging
+import pstats
 import sys
 import re
+import operator
 import os
-from openai import OpenAI
-from typing import List, Dict, Tuple, Any
-
-# Initialize the OpenAI client
-client = OpenAI(
-    api_key="YOUR-API-KEY")
+import random
+import select
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from openai import OpenAI, APIConnectionError, APIStatusError, RateLimitError
+from collections import Counter
+from collections.abc import MutableMapping
+from typing import List, Dict, Tuple, Any, Optional, Iterator, Callable
+
+logger = logging.getLogger("autodoc")
+
+# Replace with your API key or set the OPENAI_API_KEY environment variable
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "YOUR-API-KEY")
+
+MODEL = "gpt-4o"
+BACKENDS = ["openai", "fake"]
+FAKE_LATENCY = 0.0
+FAKE_COMPLETION_TOKENS = 300
+# Estimated USD per million (prompt, completion) tokens, used for the cost in the run report
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+# Requests through the Batch API cost this fraction of the regular price
+BATCH_PRICE_FACTOR = 0.5
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+DEFAULT_LOG_LEVEL = "INFO"
+PROFILE_FILE = "autodoc.prof"
+PROFILE_TOP_FUNCTIONS = 25
+
+# Bump whenever the summary prompt changes in a way that should invalidate cached summaries
+PROMPT_VERSION = 1
+# Bump whenever the title and overview prompt changes
+TITLE_PROMPT_VERSION = 1
+# Bump whenever the directory rollup prompt changes
+ROLLUP_PROMPT_VERSION = 1
+# Bump whenever the preprocessing of the source files changes
+PREPROCESS_VERSION = 2
 
 INTERMEDIATE_RESULTS_FILE = "intermediate_results.json"
-
-def load_intermediate_results() -> Dict[str, Dict[str, Any]]:
-    """Load intermediate results from a JSON file."""
-    if os.path.exists(INTERMEDIATE_RESULTS_FILE):
-        print("Loading intermediate results from file...")
-        with open(INTERMEDIATE_RESULTS_FILE, "r", encoding="utf-8") as file:
-            return json.load(file)
-    print("No intermediate results found. Starting fresh...")
-    return {}
-
-
-def save_intermediate_results(results: Dict[str, Dict[str, Any]]):
-    """Save intermediate results to a JSON file."""
-    print("Saving intermediate results to file...")
-    with open(INTERMEDIATE_RESULTS_FILE, "w", encoding="utf-8") as file:
-        json.dump(results, file, ensure_ascii=False, indent=4)
+RESULTS_STORE_FILES = {
+    "json": INTERMEDIATE_RESULTS_FILE,
+    "jsonl": "intermediate_results.jsonl",
+    "sqlite": "intermediate_results.sqlite",
+}
+DEFAULT_RESULTS_BACKEND = "jsonl"
+# Records of the intermediate results that don't belong to a component
+TITLE_OVERVIEW_KEY = "__title_overview__"
+README_KEY = "__readme__"
+ROLLUP_KEY_PREFIX = "__rollup__:"
+FINGERPRINT_KEY_PREFIX = "__fingerprint__:"
+DUPLICATE_DIFF_KEY_PREFIX = "__duplicate_diff__:"
+
+FILE_TYPES = [".h", ".cpp", ".glsl", "CMakeLists.txt"]
+
+# Deduplication: near-duplicates are found with one-permutation MinHash over shingles of DEDUP_SHINGLE_TOKENS
+# tokens, candidates come from DEDUP_LSH_BANDS bands of the signature and are verified against the threshold
+DEDUP_SHINGLE_TOKENS = 5
+DEDUP_MINHASH_BINS = 64
+DEDUP_FINGERPRINT_VERSION = 1  # increase when the shingles or signatures change to invalidate stored fingerprints
+DEDUP_LSH_BANDS = 16
+# Only the candidates sharing the most bands are compared
+DEDUP_MAX_CANDIDATES = 8
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# Smaller components are only deduplicated if they are identical
+DEDUP_MIN_TOKENS = 50
+DEDUP_DIFF_MAX_LINES = 20
+# Duplicates are listed after the other components and are never used for the project overview
+DUPLICATE_RELEVANCE = 1.0
+
+# Project overview: "top" uses the 5 most relevant components, "rollup" summarizes directories bottom-up
+OVERVIEW_MODES = ["top", "rollup"]
+DEFAULT_OVERVIEW_MODE = "top"
+# Token budget of each directory rollup prompt and of the final prompt, shared by the overview and the file tree
+ROLLUP_INPUT_TOKENS = 6000
+# Each component summary or subdirectory rollup is cut to this many tokens in a rollup prompt
+ROLLUP_ITEM_TOKENS = 300
+ROLLUP_SUMMARY_WORDS = 150
+
+# Preprocessing of the files before they are sent: license banners and redundant whitespace are removed and
+# function bodies and initializers longer than MAX_BODY_TOKENS are cut, can be changed on the command line
+PREPROCESS = True
+MAX_BODY_TOKENS = 100
+LICENSE_PATTERN = re.compile(r"copyright|licen[cs]e|spdx|permission is hereby granted|all rights reserved", re.IGNORECASE)
+
+# Scheduling: pending components are summarized most relevant first, predicted from the previous summary or,
+# for new components, from their names
+PREDICTED_RELEVANCE = 5.0
+MAIN_FILE_RELEVANCE = 10.0
+TEST_FILE_RELEVANCE = 1.0
+BUILD_FILE_RELEVANCE = 0.0
+STALE_SECTION_NOTE = ("> **Outdated:** the files of this component changed since this summary was written. "
+                      "It will be updated by the next run.")
+
+# Watch mode: wait for this many seconds without changes before updating, poll interval without inotify
+WATCH_DEBOUNCE = 1.0
+WATCH_POLL_INTERVAL = 2.0
+
+# Concurrency and rate limit defaults, can be overridden on the command line
+MAX_CONCURRENT_REQUESTS = 8
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 30000
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+EXPECTED_COMPLETION_TOKENS = 1000
+
+# Batch API mode (--batch): pending summaries are submitted as batches and polled until they are done
+BATCH_DIR = "batches"
+BATCH_STATE_FILE = "batch_state.json"
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_POLL_INTERVAL = 30.0
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Components whose prompt would exceed this many tokens are summarized in chunks (map-reduce)
+MAX_PROMPT_TOKENS = 12000
+MIN_CHUNK_TOKENS = 1000
+
+# Folder mappings used to pair headers and sources in different folders, e.g. include/foo.h with src/foo.cpp
+DEFAULT_PAIRING_RULES = ["include:src", "inc:src", "public:private"]
+
+# How much of the project structure is included in each component prompt, see `ProjectContext`
+CONTEXT_MODES = ["full", "tree", "local", "digest"]
+DEFAULT_CONTEXT_MODE = "local"
+DIGEST_MAX_FOLDERS = 20
+LOCAL_MAX_FILES = 50
+LOCAL_MAX_NEIGHBOURS = 20
+
+
+class LLMResponse:
+    """The text of a chat completion and the number of tokens it used."""
+
+    def __init__(self, content: str, prompt_tokens: int, completion_tokens: int):
+        self.content = content
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class LLMBackend:
+    """Interface of the language model backends that answer all chat completion requests."""
+
+    def complete(self, messages: List[Dict[str, str]], model: str) -> LLMResponse:
+        raise NotImplementedError
+
+
+class OpenAIBackend(LLMBackend):
+    """Sends requests to the OpenAI API (or a compatible server set with OPENAI_BASE_URL)."""
+
+    def __init__(self, api_key: str = OPENAI_API_KEY):
+        # Retries are handled by `create_chat_completion`
+        self.client = OpenAI(api_key=api_key, max_retries=0)
+
+    def complete(self, messages: List[Dict[str, str]], model: str) -> LLMResponse:
+        completion = self.client.chat.completions.create(
+            model=model,
+            messages=messages
+        )
+        content = completion.choices[0].message.content
+        if completion.usage is None:
+            return LLMResponse(content, sum(estimate_tokens(m["content"]) for m in messages), estimate_tokens(content))
+        return LLMResponse(content, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+
+
+class FakeBackend(LLMBackend):
+    """Answers instantly (or after `latency` seconds) with deterministic summaries in the expected format.
+
+    Used for benchmarks and for trying the pipeline without an API key. Prompt tokens are estimated,
+    every answer is padded to about `completion_tokens` tokens.
+    """
+
+    def __init__(self, latency: float = FAKE_LATENCY, completion_tokens: int = FAKE_COMPLETION_TOKENS):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+
+    @staticmethod
+    def fake_content(messages: List[Dict[str, str]]) -> str:
+        """Returns a deterministic answer for the messages, derived from the prompt."""
+        system = messages[0]["content"] if messages else ""
+        prompt = messages[-1]["content"] if messages else ""
+        digest = int(hash_text(prompt), 16)
+        if "architecture of software projects" in system:
+            directory = re.search(r"directory `([^`]*)`", prompt)
+            return f"Fake rollup of {directory.group(1) if directory else 'a directory'} ({digest % 10000:04d})."
+        if "project titles" in system:
+            return ("Project Title: Fake Project\n\nProject Overview: A project summarized by the fake backend.\n\n"
+                    "File Tree Graph:\n```\nFakeProject\n```")
+        match = re.search(r"code files? named ([^\n]+?)\.(?:\s|$)", prompt)
+        names = match.group(1).replace(", ", " & ") if match else "component"
+        return (f"## {names}\n### Overview\nFake summary of {names}.\n### Public Interface\nFake interface.\n"
+                f"### Implementation\nFake implementation.\n[Relevance score: {digest % 10 + 1}]")
+
+    def complete(self, messages: List[Dict[str, str]], model: str) -> LLMResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        content = self.fake_content(messages)
+        padding = max(0, self.completion_tokens - estimate_tokens(content))
+        if padding:
+            content = content.replace("Fake implementation.", "Fake implementation." + " detail" * padding, 1)
+        return LLMResponse(content, sum(estimate_tokens(m["content"]) for m in messages), estimate_tokens(content))
+
+
+class RecordReplayBackend(LLMBackend):
+    """Records the responses of another backend to a JSONL file, or replays them without any backend.
+
+    Responses are looked up by a hash of the model and the messages. Replaying a request that was not
+    recorded raises a KeyError.
+    """
+
+    def __init__(self, path: str, backend: Optional[LLMBackend] = None):
+        self.path = path
+        self.backend = backend
+        self.responses = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.responses[entry["key"]] = entry
+        elif backend is None:
+            raise FileNotFoundError(f"No recorded responses found at {path}.")
+
+    @staticmethod
+    def request_key(messages: List[Dict[str, str]], model: str) -> str:
+        return hash_text(json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False))
+
+    def complete(self, messages: List[Dict[str, str]], model: str) -> LLMResponse:
+        key = self.request_key(messages, model)
+        if self.backend is None:
+            if key not in self.responses:
+                raise KeyError(f"No recorded response for request {key} in {self.path}.")
+            entry = self.responses[key]
+            return LLMResponse(entry["content"], entry["prompt_tokens"], entry["completion_tokens"])
+
+        response = self.backend.complete(messages, model)
+        entry = {"key": key, "content": response.content, "prompt_tokens": response.prompt_tokens,
+                 "completion_tokens": response.completion_tokens}
+        with self.lock:
+            self.responses[key] = entry
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return response
+
+
+backend = None
+
+
+def get_backend() -> LLMBackend:
+    """Returns the configured backend, creating the OpenAI backend on first use if none was configured."""
+    global backend
+    if backend is None:
+        backend = OpenAIBackend()
+    return backend
+
+
+def configure_backend(new_backend: LLMBackend, model: str = MODEL):
+    """Sets the backend and the model used for all requests."""
+    global backend, MODEL
+    backend = new_backend
+    MODEL = model
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, batch: bool = False) -> Optional[float]:
+    """Estimates the cost of a request in USD from MODEL_PRICES, or None for models without a known price."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    cost = (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if batch else cost
+
+
+class RunStats:
+    """Counts the requests, tokens, costs, cache hits and time spent in each stage of a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.monotonic()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.unpriced_requests = 0
+        self.request_log = []
+        self.cache_outcomes = {}  # file_key -> whether it was a cache hit, the first lookup of a key counts
+        self.stages = {}  # stage -> [calls, total seconds, longest call in seconds]
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.preprocessing = {}  # file_key -> (tokens before, tokens after preprocessing)
+        self.budget_exhausted = None  # "time" or "tokens" if a budget stopped the run early
+        self.stale_components = 0
+        self.missing_components = 0
+
+    def record_request(self, response: LLMResponse, model: str, label: str = "", seconds: float = 0.0,
+                       batch: bool = False):
+        cost = estimate_cost(model, response.prompt_tokens, response.completion_tokens, batch)
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += response.prompt_tokens
+            self.completion_tokens += response.completion_tokens
+            if cost is None:
+                self.unpriced_requests += 1
+            else:
+                self.cost += cost
+            self.request_log.append({
+                "label": label,
+                "model": model,
+                "batch": batch,
+                "prompt_tokens": response.prompt_tokens,
+                "completion_tokens": response.completion_tokens,
+                "cost": cost,
+                "seconds": round(seconds, 3),
+            })
+        logger.debug(f"Request {label or '(unlabeled)'}: {response.prompt_tokens} prompt + "
+                     f"{response.completion_tokens} completion tokens, "
+                     f"{'unknown cost' if cost is None else f'${cost:.4f}'}, {seconds:.2f}s")
+
+    def record_cache_lookup(self, file_key: str, hit: bool):
+        with self.lock:
+            self.cache_outcomes.setdefault(file_key, hit)
+
+    def record_unfinished(self, budget_exhausted: Optional[str], stale: int, missing: int):
+        with self.lock:
+            self.budget_exhausted = budget_exhausted
+            self.stale_components = stale
+            self.missing_components = missing
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def record_preprocessing(self, file_key: str, tokens_before: int, tokens_after: int):
+        with self.lock:
+            self.preprocessing[file_key] = (tokens_before, tokens_after)
+
+    def record_duplicates(self, exact: int, near: int):
+        with self.lock:
+            self.exact_duplicates = exact
+            self.near_duplicates = near
+
+    def record_stage(self, stage: str, seconds: float):
+        with self.lock:
+            calls = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            calls[0] += 1
+            calls[1] += seconds
+            calls[2] = max(calls[2], seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Adds the time spent in the block to `stage`. Stages that run on several threads add up their time."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    @property
+    def cache_hits(self) -> int:
+        return sum(self.cache_outcomes.values())
+
+    @property
+    def cache_misses(self) -> int:
+        return len(self.cache_outcomes) - self.cache_hits
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = len(self.cache_outcomes)
+            return {
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "wall_seconds": round(time.monotonic() - self.started, 3),
+                "model": MODEL,
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "estimated_cost": round(self.cost, 6),
+                "unpriced_requests": self.unpriced_requests,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": self.cache_hits / lookups if lookups else 0.0,
+                "budget_exhausted": self.budget_exhausted,
+                "stale_components": self.stale_components,
+                "missing_components": self.missing_components,
+                "exact_duplicates": self.exact_duplicates,
+                "near_duplicates": self.near_duplicates,
+                "requests_avoided_by_dedup": self.exact_duplicates + self.near_duplicates,
+                "tokens_before_preprocessing": sum(before for before, _ in self.preprocessing.values()),
+                "tokens_after_preprocessing": sum(after for _, after in self.preprocessing.values()),
+                "preprocessing_log": [{"component": file_key, "tokens_before": before, "tokens_after": after}
+                                      for file_key, (before, after) in self.preprocessing.items()],
+                "stages": {stage: {"calls": calls, "seconds": round(total, 3), "max_seconds": round(longest, 3)}
+                           for stage, (calls, total, longest) in self.stages.items()},
+                "request_log": list(self.request_log),
+            }
 
 
-def list_files(root_dir: str, root_file_types: List[str], recursive_dirs: List[str], recursive_file_types: List[str]) -> Dict[str, List[str]]:
-    """Lists files in the root directory non-recursively and in specified folders recursively."""
-    print(f"Listing files in {root_dir} and subdirectories...")
+run_stats = RunStats()
+
+
+def reset_run_stats() -> RunStats:
+    """Starts counting a new run."""
+    global run_stats
+    run_stats = RunStats()
+    return run_stats
+
+
+def timed(stage: str) -> Callable:
+    """Decorator that adds the time spent in the function to `stage` of the current run statistics."""
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with run_stats.timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_run_report(stats: Dict[str, Any], path: str):
+    """Writes the statistics of a run as a JSON report."""
+    write_file_atomically(path, json.dumps(stats, indent=2).encode("utf-8"))
+    logger.info(f"Run report written to {path}")
+
+
+def prometheus_metrics(stats: Dict[str, Any]) -> str:
+    """Formats the statistics of a run in the Prometheus text format, e.g. for the node exporter's textfile collector."""
+    metrics = [
+        ("autodoc_run_timestamp_seconds", "Start of the last run as a Unix timestamp.",
+         [("", datetime.fromisoformat(stats["started_at"]).timestamp())]),
+        ("autodoc_run_duration_seconds", "Wall time of the last run.", [("", stats["wall_seconds"])]),
+        ("autodoc_run_requests", "Chat completion requests sent in the last run.", [("", stats["requests"])]),
+        ("autodoc_run_tokens", "Tokens used in the last run.",
+         [('{kind="prompt"}', stats["prompt_tokens"]), ('{kind="completion"}', stats["completion_tokens"])]),
+        ("autodoc_run_estimated_cost_dollars", "Estimated cost of the last run.", [("", stats["estimated_cost"])]),
+        ("autodoc_run_cache_lookups", "Component summary cache lookups in the last run.",
+         [('{outcome="hit"}', stats["cache_hits"]), ('{outcome="miss"}', stats["cache_misses"])]),
+        ("autodoc_run_source_tokens", "Tokens of the summarized files before and after preprocessing in the last run.",
+         [('{stage="before"}', stats["tokens_before_preprocessing"]),
+          ('{stage="after"}', stats["tokens_after_preprocessing"])]),
+        ("autodoc_run_budget_exhausted", "Whether a time or token budget stopped the last run early.",
+         [("", int(stats["budget_exhausted"] is not None))]),
+        ("autodoc_run_unfinished_components", "Components left with an outdated summary or none in the last run.",
+         [('{kind="stale"}', stats["stale_components"]), ('{kind="missing"}', stats["missing_components"])]),
+        ("autodoc_run_duplicate_components", "Components that reference the summary of a duplicate instead of their own.",
+         [('{kind="exact"}', stats["exact_duplicates"]), ('{kind="near"}', stats["near_duplicates"])]),
+        ("autodoc_run_stage_seconds", "Time spent in each stage of the last run, summed over threads.",
+         [(f'{{stage="{stage}"}}', values["seconds"]) for stage, values in sorted(stats["stages"].items())]),
+        ("autodoc_run_stage_calls", "Calls of each stage in the last run.",
+         [(f'{{stage="{stage}"}}', values["calls"]) for stage, values in sorted(stats["stages"].items())]),
+    ]
+    lines = []
+    for name, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(stats: Dict[str, Any], path: str):
+    """Writes the statistics of a run as a Prometheus textfile. The file is replaced atomically, as the collector expects."""
+    write_file_atomically(path, prometheus_metrics(stats).encode("utf-8"))
+    logger.info(f"Prometheus metrics written to {path}")
+
+
+def log_run_summary(stats: Dict[str, Any]):
+    """Logs the totals of a run and the time spent in each stage."""
+    cost = f"${stats['estimated_cost']:.4f}"
+    if stats["unpriced_requests"]:
+        cost += f" (+{stats['unpriced_requests']} requests without a known price)"
+    logger.info(f"Run finished in {stats['wall_seconds']:.1f}s: {stats['requests']} requests, "
+                f"{stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens, "
+                f"estimated cost {cost}, {stats['cache_hits']} cache hits, {stats['cache_misses']} misses, "
+                f"{stats['requests_avoided_by_dedup']} summaries avoided by deduplication.")
+    if stats["budget_exhausted"]:
+        logger.warning(f"The {stats['budget_exhausted']} budget ran out: {stats['stale_components']} components kept "
+                       f"an outdated summary and {stats['missing_components']} have none yet.")
+    if stats["tokens_before_preprocessing"]:
+        saved = stats["tokens_before_preprocessing"] - stats["tokens_after_preprocessing"]
+        logger.info(f"Preprocessing cut the summarized files from {stats['tokens_before_preprocessing']} to "
+                    f"{stats['tokens_after_preprocessing']} tokens (saving {saved / stats['tokens_before_preprocessing']:.1%}).")
+    for stage, values in sorted(stats["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        logger.info(f"  {stage}: {values['seconds']:.2f}s in {values['calls']} calls "
+                    f"(longest {values['max_seconds']:.2f}s)")
+
+
+class TokenBucket:
+    """A thread-safe token bucket that refills continuously up to `capacity_per_minute`."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0):
+        """Blocks until `amount` tokens are available and takes them from the bucket."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount: float):
+        """Takes (or gives back, if negative) tokens once the real cost of a request is known."""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+
+class RateLimiter:
+    """Bounds the number of in-flight requests as well as the requests and tokens sent per minute."""
+
+    def __init__(self, max_concurrent_requests: int, requests_per_minute: float, tokens_per_minute: float):
+        self.in_flight = threading.BoundedSemaphore(max_concurrent_requests)
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+
+    @contextmanager
+    def slot(self, estimated_tokens: int):
+        """Waits until a request with `estimated_tokens` may be sent without exceeding the limits."""
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens:
+            self.tokens.acquire(estimated_tokens)
+        with self.in_flight:
+            yield
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Corrects the token bucket with the token count reported by the API."""
+        if self.tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+
+rate_limiter = RateLimiter(MAX_CONCURRENT_REQUESTS, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+def configure_rate_limiter(max_concurrent_requests: int, requests_per_minute: float, tokens_per_minute: float):
+    """Replaces the global rate limiter with one using the given limits."""
+    global rate_limiter
+    rate_limiter = RateLimiter(max_concurrent_requests, requests_per_minute, tokens_per_minute)
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cuts a text after about `max_tokens` tokens, counted like `estimate_tokens`."""
+    for index, match in enumerate(TOKEN_PATTERN.finditer(text)):
+        if index == max_tokens:
+            return text[:match.start()].rstrip() + " ..."
+    return text
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens in a text without a tokenizer.
+
+    Every punctuation character counts as one token and words as one token per started 6 characters,
+    which slightly overestimates the GPT-4o tokenizer for source code.
+    """
+    return sum(1 + (len(token) - 1) // 6 for token in TOKEN_PATTERN.findall(text))
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Rate limits, server errors and connection problems are worth retrying, anything else is not."""
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Exponential backoff with full jitter, honoring the Retry-After header if the server sent one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class Budget:
+    """Limits the time and tokens component summaries may use. New requests are only started while both last."""
+
+    def __init__(self, max_seconds: Optional[float] = None, max_tokens: Optional[int] = None):
+        self.deadline = time.monotonic() + max_seconds if max_seconds else None
+        self.max_tokens = max_tokens
+        self.reserved_tokens = 0  # estimated tokens of the requests in flight
+        self.exhausted = None
+        self.lock = threading.Lock()
+
+    def reserve(self, estimated_tokens: int) -> bool:
+        """Reserves the tokens of a request if the budget allows it. Once it doesn't, no further request is allowed."""
+        with self.lock:
+            if self.exhausted is None:
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self.exhausted = "time"
+                elif (self.max_tokens is not None and
+                      run_stats.total_tokens + self.reserved_tokens + estimated_tokens > self.max_tokens):
+                    self.exhausted = "tokens"
+                else:
+                    self.reserved_tokens += estimated_tokens
+                    return True
+                logger.warning(f"The {self.exhausted} budget is used up. No further summaries are requested.")
+            return False
+
+    def release(self, estimated_tokens: int):
+        """Releases the reservation of a finished request, whose actual tokens are counted by the run statistics."""
+        with self.lock:
+            self.reserved_tokens -= estimated_tokens
+
+
+def create_chat_completion(messages: List[Dict[str, str]], label: str = "") -> LLMResponse:
+    """Sends a chat completion request to the backend through the rate limiter and retries transient failures.
+
+    `label` names the request in the run report.
+    """
+    estimated_tokens = sum(estimate_tokens(message["content"]) for message in messages) + EXPECTED_COMPLETION_TOKENS
+
+    start = time.perf_counter()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with rate_limiter.slot(estimated_tokens), run_stats.timer("chat_completion"):
+                response = get_backend().complete(messages, MODEL)
+        except Exception as error:
+            if not is_retryable_error(error) or attempt == MAX_RETRIES:
+                raise
+            delay = retry_delay(error, attempt)
+            logger.warning(f"Request failed ({error.__class__.__name__}). Retrying in {delay:.1f}s "
+                           f"(attempt {attempt + 1}/{MAX_RETRIES})...")
+            time.sleep(delay)
+            continue
+
+        rate_limiter.record_usage(estimated_tokens, response.total_tokens)
+        run_stats.record_request(response, MODEL, label, time.perf_counter() - start)
+        return response
+
+
+class ResultsStore(MutableMapping):
+    """Base class of the intermediate results stores. Assigning a key persists that single record right away."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.content_hashes = None  # content hash -> key, built on first use
+
+    def _put(self, key: str, value: Dict[str, Any]):
+        raise NotImplementedError
+
+    def __setitem__(self, key: str, value: Dict[str, Any]):
+        with self.lock:
+            self._put(key, value)
+            if self.content_hashes is not None and value.get("content_hash"):
+                self.content_hashes[value["content_hash"]] = key
+
+    def put_many(self, records: Dict[str, Dict[str, Any]]):
+        """Stores several records at once."""
+        with self.lock:
+            for key, value in records.items():
+                self[key] = value
+
+    def find_by_content_hash(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Finds a record with the given content hash under any key, e.g. for files that were moved or renamed."""
+        with self.lock:
+            if self.content_hashes is None:
+                self.content_hashes = {}
+                for key in self:
+                    stored_hash = self[key].get("content_hash")
+                    if stored_hash:
+                        self.content_hashes[stored_hash] = key
+            key = self.content_hashes.get(content_hash)
+            record = self.get(key) if key is not None else None
+        return record if record and record.get("content_hash") == content_hash else None
+
+    def compact(self):
+        """Rewrites the store without stale records. Stores that never accumulate any don't need to."""
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+class JsonResultsStore(ResultsStore):
+    """The original format: one JSON object that is rewritten (atomically) on every update."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.records = json.load(file)
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        return self.records[key]
+
+    def _put(self, key: str, value: Dict[str, Any]):
+        self.records[key] = value
+        self.compact()
+
+    def put_many(self, records: Dict[str, Dict[str, Any]]):
+        # Rewrites the file once instead of once per record
+        with self.lock:
+            self.records.update(records)
+            self.content_hashes = None
+            self.compact()
+
+    def __delitem__(self, key: str):
+        with self.lock:
+            del self.records[key]
+            self.compact()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.records))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def compact(self):
+        with self.lock:
+            write_file_atomically(self.path, json.dumps(self.records, ensure_ascii=False, indent=4).encode("utf-8"))
+
+
+class JsonlResultsStore(ResultsStore):
+    """Append-only log with one `<json key>\t<json value>` line per update.
+
+    Opening the store indexes the keys and checks that every value decodes, values are read from disk again when
+    they are accessed. A line cut off by a crash at the end is dropped on the next start, corrupt lines elsewhere
+    are skipped and removed by the next compaction, and `compact` rewrites the log atomically.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.index = {}  # key -> (offset, length) of the latest line for that key
+        self.line_count = 0
+        valid_size = 0
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        logger.warning(f"Dropping incomplete record at the end of {path}.")
+                        break
+                    offset = valid_size
+                    valid_size += len(line)
+                    self.line_count += 1
+                    key_part, _, value_part = line.partition(b"\t")
+                    try:
+                        key = json.loads(key_part)
+                        value = json.loads(value_part)
+                    except ValueError:
+                        key = value = None
+                    if not isinstance(key, str) or not (value is None or isinstance(value, dict)):
+                        # Counts as a stale line, so compaction removes it
+                        logger.warning(f"Skipping corrupt record on line {self.line_count} of {path}.")
+                        continue
+                    if value is None:
+                        self.index.pop(key, None)
+                    else:
+                        self.index[key] = (offset, len(line))
+            if valid_size != os.path.getsize(path):
+                with open(path, "r+b") as file:
+                    file.truncate(valid_size)
+        self.writer = open(path, "ab")
+        self.reader = open(path, "rb")
+
+    @staticmethod
+    def _encode_line(key: str, value: Optional[Dict[str, Any]]) -> bytes:
+        return (json.dumps(key, ensure_ascii=False) + "\t" + json.dumps(value, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _append(self, key: str, value: Optional[Dict[str, Any]]) -> Tuple[int, int]:
+        line = self._encode_line(key, value)
+        offset = self.writer.tell()
+        self.writer.write(line)
+        self.writer.flush()
+        self.line_count += 1
+        return offset, len(line)
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        with self.lock:
+            offset, length = self.index[key]
+            self.reader.seek(offset)
+            line = self.reader.read(length)
+        return json.loads(line.partition(b"\t")[2])
+
+    def _put(self, key: str, value: Dict[str, Any]):
+        self.index[key] = self._append(key, value)
+
+    def __delitem__(self, key: str):
+        with self.lock:
+            del self.index[key]
+            self._append(key, None)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.index))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def needs_compaction(self) -> bool:
+        return self.line_count > 2 * len(self.index)
+
+    def compact(self):
+        with self.lock:
+            lines = {key: self._encode_line(key, self[key]) for key in self.index}
+            self.writer.close()
+            self.reader.close()
+            write_file_atomically(self.path, b"".join(lines.values()))
+            self.index = {}
+            offset = 0
+            for key, line in lines.items():
+                self.index[key] = (offset, len(line))
+                offset += len(line)
+            self.line_count = len(self.index)
+            self.writer = open(self.path, "ab")
+            self.reader = open(self.path, "rb")
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            self.reader.close()
+
+
+class SqliteResultsStore(ResultsStore):
+    """SQLite database in WAL mode, every update is its own small transaction."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def _put(self, key: str, value: Dict[str, Any]):
+        self.connection.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                                (key, json.dumps(value, ensure_ascii=False)))
+
+    def __delitem__(self, key: str):
+        with self.lock:
+            if self.connection.execute("DELETE FROM results WHERE key = ?", (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        with self.lock:
+            return iter([row[0] for row in self.connection.execute("SELECT key FROM results")])
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def compact(self):
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.connection.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+RESULTS_STORES = {
+    "json": JsonResultsStore,
+    "jsonl": JsonlResultsStore,
+    "sqlite": SqliteResultsStore,
+}
+
+
+def write_file_atomically(path: str, content: bytes):
+    """Writes to a temporary file next to `path` and moves it into place, so `path` is never left half-written."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_intermediate_results(backend: str = DEFAULT_RESULTS_BACKEND, path: Optional[str] = None) -> ResultsStore:
+    """Opens the intermediate results store, migrating the legacy JSON file into a new store if there is one."""
+    path = path or RESULTS_STORE_FILES[backend]
+    is_new = not os.path.exists(path)
+    logger.info(f"Loading intermediate results from {path} ({backend})...")
+    results = RESULTS_STORES[backend](path)
+
+    if is_new and backend != "json" and os.path.exists(INTERMEDIATE_RESULTS_FILE):
+        logger.info(f"Migrating intermediate results from {INTERMEDIATE_RESULTS_FILE}...")
+        with open(INTERMEDIATE_RESULTS_FILE, "r", encoding="utf-8") as file:
+            for key, record in json.load(file).items():
+                results[key] = record
+        logger.info(f"Migrated {len(results)} records. {INTERMEDIATE_RESULTS_FILE} is no longer used and can be deleted.")
+    elif not len(results):
+        logger.info("No intermediate results found. Starting fresh...")
+    return results
+
+
+@timed("save_intermediate_results")
+def save_intermediate_results(results: ResultsStore, key: str, record: Dict[str, Any]):
+    """Saves a single summary record to the intermediate results store, noting when it was saved."""
+    logger.debug(f"Saving intermediate results for {key}...")
+    results[key] = {**record, 'updated_at': datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+
+def results_backend_for_path(path: str, default: str = DEFAULT_RESULTS_BACKEND) -> str:
+    """Guesses the backend of an intermediate results file from its extension."""
+    extension = os.path.splitext(path)[1]
+    for backend, file_name in RESULTS_STORE_FILES.items():
+        if os.path.splitext(file_name)[1] == extension:
+            return backend
+    return default
+
+
+def shard_results_file(backend: str, shard: Tuple[int, int]) -> str:
+    """Returns the default intermediate results file of a shard, e.g. intermediate_results.shard-2-of-4.jsonl."""
+    base, extension = os.path.splitext(RESULTS_STORE_FILES[backend])
+    return f"{base}.shard-{shard[0]}-of-{shard[1]}{extension}"
+
+
+def record_preference(record: Dict[str, Any], current_hashes: set) -> Tuple[bool, str, int]:
+    """Orders conflicting records: one matching the current files first, then the most recently saved one."""
+    newest_mtime = max((f.get('mtime_ns', 0) for f in record.get('files', [])), default=0)
+    return record.get('content_hash') in current_hashes, record.get('updated_at', ""), newest_mtime
+
+
+def merge_intermediate_results(paths: List[str], results: ResultsStore, components: List[Tuple[str, List[str]]]) -> int:
+    """Copies the records of the given intermediate results files into `results`.
+
+    If several files (or `results` itself) have a record for a key, the one for the current content of the
+    `components` wins, then the newest. Returns the number of records written.
+    """
+    merged = {}
+    shard_stores = []
+    try:
+        for path in paths:
+            shard_stores.append(load_intermediate_results(results_backend_for_path(path), path))
+        current_hashes = current_content_hashes(components, [results] + shard_stores)
+        for shard_results in shard_stores:
+            for key in shard_results:
+                record = shard_results[key]
+                best = merged.get(key, results.get(key))
+                if best is None or record_preference(record, current_hashes) > record_preference(best, current_hashes):
+                    merged[key] = record
+    finally:
+        for shard_results in shard_stores:
+            shard_results.close()
+    for key, record in merged.items():
+        results[key] = record
+    logger.info(f"Merged {len(merged)} records from {len(paths)} files into {results.path}.")
+    return len(merged)
+
+
+def close_intermediate_results(results: ResultsStore, compact: bool = False):
+    """Compacts the intermediate results store if requested or if it has accumulated stale records, and closes it."""
+    if compact or results.needs_compaction():
+        logger.info("Compacting intermediate results...")
+        results.compact()
+    results.close()
+
+
+class FileTypeMatcher:
+    """Decides whether a file name matches one of the file types, using set lookups instead of one test per type.
+
+    Plain extensions like '.h' are looked up by extension, full names like 'CMakeLists.txt' by name and
+    anything else falls back to a suffix test.
+    """
+
+    def __init__(self, file_types: List[str]):
+        self.extensions = {ft for ft in file_types if ft.startswith(".") and ft.count(".") == 1}
+        self.names = {ft for ft in file_types if not ft.startswith(".")}
+        self.suffixes = tuple(ft for ft in file_types if ft not in self.extensions and ft not in self.names)
+
+    def matches(self, file_name: str) -> bool:
+        dot = file_name.rfind(".")
+        if dot != -1 and file_name[dot:] in self.extensions:
+            return True
+        if file_name in self.names:
+            return True
+        return bool(self.suffixes) and file_name.endswith(self.suffixes)
+
+
+class IgnoreRules:
+    """Exclude patterns with .gitignore semantics, matched against paths relative to the project root.
+
+    Supports comments, '!' negation, trailing '/' for directories only, patterns anchored by a '/',
+    '*', '?', '[...]' and '**'. The last matching pattern wins.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.rstrip("\n").rstrip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            regex = self.translate(pattern.lstrip("/"))
+            regex = regex if anchored else f"(?:.*/)?{regex}"
+            self.rules.append((re.compile(f"^{regex}$"), negated, directory_only))
+
+    @staticmethod
+    def translate(pattern: str) -> str:
+        """Translates a gitignore glob into a regular expression."""
+        regex = ""
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+                regex += "/.*"
+                i += 3
+            elif pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif pattern[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif pattern[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 1)
+                regex += "[" + pattern[i + 1:end].replace("!", "^", 1) + "]"
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex
+
+    def is_ignored(self, relative_path: str, is_dir: bool) -> bool:
+        ignored = False
+        for regex, negated, directory_only in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                ignored = not negated
+        return ignored
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+
+def load_ignore_rules(root_dir: str, exclude_patterns: List[str], use_gitignore: bool = True) -> IgnoreRules:
+    """Combines the .gitignore of the project root (if any) with the exclude patterns given on the command line."""
+    patterns = []
+    gitignore_path = os.path.join(root_dir, ".gitignore")
+    if use_gitignore and os.path.isfile(gitignore_path):
+        with open(gitignore_path, "r", encoding="utf-8") as file:
+            patterns.extend(file.readlines())
+    patterns.extend(exclude_patterns)
+    return IgnoreRules(patterns)
+
+
+def relative_to_root(path: str, root_dir: str) -> str:
+    """Returns `path` relative to the project root with forward slashes, '.' for the root itself."""
+    relative = os.path.relpath(path, root_dir).replace(os.sep, "/")
+    return "." if relative == "." else relative
+
+
+def scan_directory(directory: str, matcher: FileTypeMatcher, recursive: bool, root_dir: str,
+                   ignore_rules: Optional[IgnoreRules], project_structure: Dict[str, List[str]]):
+    """Walks a directory with os.scandir, adding matching files per folder to `project_structure`."""
+    relative_directory = relative_to_root(directory, root_dir)
+    stack = [(directory, "" if relative_directory == "." else relative_directory + "/")]
+    while stack:
+        current, relative_prefix = stack.pop()
+        relevant_files = []
+        subdirs = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if ignore_rules and ignore_rules.is_ignored(relative_prefix + entry.name, is_dir):
+                        continue
+                    if is_dir:
+                        if recursive:
+                            subdirs.append((entry.path, relative_prefix + entry.name + "/"))
+                    elif matcher.matches(entry.name):
+                        relevant_files.append(entry.path)
+        except OSError as error:
+            logger.warning(f"Could not list {current}: {error}")
+            continue
+        if relevant_files:
+            project_structure[current] = relevant_files
+        # Reversed, so folders are visited in the order they were listed
+        stack.extend(reversed(subdirs))
+
+
+@timed("list_files")
+def list_files(root_dir: str, root_file_types: List[str], recursive_dirs: List[str], recursive_file_types: List[str],
+               ignore_rules: Optional[IgnoreRules] = None) -> Dict[str, List[str]]:
+    """Lists files in the root directory non-recursively and in specified folders recursively, skipping ignored paths."""
+    logger.info(f"Listing files in {root_dir} and subdirectories...")
     project_structure = {}
 
     # Scan the root directory (non-recursively)
-    root_files = [os.path.join(root_dir, file) for file in os.listdir(root_dir) if
-                  any(file.endswith(ft) for ft in root_file_types)]
-    if root_files:
-        project_structure[root_dir] = root_files
+    scan_directory(root_dir, FileTypeMatcher(root_file_types), False, root_dir, ignore_rules, project_structure)
 
     # Scan the specified directories (recursively)
+    recursive_matcher = FileTypeMatcher(recursive_file_types)
     for recursive_dir in recursive_dirs:
-        print(f"Recursively listing files in {recursive_dir}...")
-        for subdir, _, files in os.walk(recursive_dir):
-            relevant_files = [os.path.join(subdir, file) for file in files if
-                              any(file.endswith(ft) for ft in recursive_file_types)]
-            if relevant_files:
-                project_structure[subdir] = relevant_files
-
-    print(f"File listing complete. Found {sum(len(files) for files in project_structure.values())} files.")
+        logger.debug(f"Recursively listing files in {recursive_dir}...")
+        scan_directory(recursive_dir, recursive_matcher, True, root_dir, ignore_rules, project_structure)
+
+    logger.info(f"File listing complete. Found {sum(len(files) for files in project_structure.values())} files.")
     return project_structure
 
 
+@timed("pair_header_and_source_files")
 def pair_header_and_source_files(files: List[str]) -> Dict[str, List[str]]:
     """Pairs .h and .cpp files with the same name, shader files, and identifies unpaired files."""
-    print("Pairing header, source, shader, and other files...")
+    logger.debug("Pairing header, source, shader, and other files...")
     paired_files = {}
     unpaired_files = []
 
-    header_files = {os.path.splitext(os.path.basename(f))[0]: f for f in files if f.endswith(".h")}
-    source_files = {os.path.splitext(os.path.basename(f))[0]: f for f in files if f.endswith(".cpp")}
-    shader_files = {os.path.splitext(os.path.basename(f))[0]: f for f in files if f.endswith(".glsl")}
-    cmake_files = [f for f in files if "CMakeLists.txt" in os.path.basename(f)]
+    header_files = {}
+    source_files = {}
+    shader_files = {}
+    cmake_files = []
+    other_files = []
+    # Sort every file into its category in a single pass
+    for f in files:
+        file_name = os.path.basename(f)
+        base_name, extension = os.path.splitext(file_name)
+        if extension == ".h":
+            header_files[base_name] = f
+        elif extension == ".cpp":
+            source_files[base_name] = f
+        elif extension == ".glsl":
+            shader_files[base_name] = f
+        elif "CMakeLists.txt" in file_name:
+            cmake_files.append(f)
+        else:
+            other_files.append(f)
 
     # Pair header and source files
-    for base_name in set(header_files.keys()).union(set(source_files.keys())):
+    for base_name in sorted(header_files.keys() | source_files.keys()):
         if base_name in header_files and base_name in source_files:
             paired_files[base_name] = [header_files[base_name], source_files[base_name]]
         elif base_name in header_files:
             unpaired_files.append(header_files[base_name])
-        elif base_name in source_files:
+        else:
             unpaired_files.append(source_files[base_name])
 
     # Pair shader files
@@ -105,19 +1230,17 @@ def pair_header_and_source_files(files: List[str]) -> Dict[str, List[str]]:
     for cmake_file in cmake_files:
         paired_files[os.path.basename(cmake_file)] = [cmake_file]
 
-    # Add any unpaired files (shader files that weren't paired, or other files)
-    unpaired_files.extend(
-        f for f in files if f not in unpaired_files and not f.endswith((".h", ".cpp", ".glsl")) and f not in paired_files.values()
-    )
+    # Add any other files
+    unpaired_files.extend(other_files)
     paired_files["unpaired_files"] = unpaired_files
 
-    print(f"Pairing complete. Paired files: {len(paired_files) - 1}, Unpaired files: {len(unpaired_files)}")
+    logger.debug(f"Pairing complete. Paired files: {len(paired_files) - 1}, Unpaired files: {len(unpaired_files)}")
     return paired_files
 
 
 def pair_shader_files(shader_files: Dict[str, str]) -> Dict[str, List[str]]:
     """Pairs shader files based on naming conventions and sorts them to ensure paired shaders are next to each other."""
-    print("Pairing shader files...")
+    logger.debug("Pairing shader files...")
     paired_files = {}
     unpaired_files = []
 
@@ -139,14 +1262,237 @@ def pair_shader_files(shader_files: Dict[str, str]) -> Dict[str, List[str]]:
             unpaired_files.extend(files)
             del paired_files[core_name]
 
-    print(f"Shader pairing complete. Paired shaders: {len(paired_files)}, Unpaired shaders: {len(unpaired_files)}")
+    logger.debug(f"Shader pairing complete. Paired shaders: {len(paired_files)}, Unpaired shaders: {len(unpaired_files)}")
     paired_files["unpaired_shaders"] = unpaired_files  # Add unpaired shaders separately
     return paired_files
 
 
+def compress_file_names(file_names: List[str]) -> str:
+    """Joins file names, folding files that only differ in their extension, e.g. 'foo.{cpp,h}'."""
+    extensions_by_stem = {}
+    for file_name in sorted(file_names):
+        stem, extension = os.path.splitext(file_name)
+        extensions_by_stem.setdefault(stem, []).append(extension)
+    names = []
+    for stem, extensions in extensions_by_stem.items():
+        if len(extensions) > 1 and all(extensions):
+            names.append(f"{stem}.{{{','.join(extension[1:] for extension in extensions)}}}")
+        else:
+            names.extend(stem + extension for extension in extensions)
+    return ", ".join(names)
+
+
+class ProjectContext:
+    """Builds the overview of the project structure that is included in the component prompts.
+
+    Modes:
+    - full: every file path of the project (the original behavior, grows with the project in every prompt)
+    - tree: an indented folder tree relative to the root with folded file names
+    - local: the folder(s) of the component, their parent and neighbouring folders
+    - digest: a fixed-size digest of the largest folders and the file types
+
+    Tracks how many tokens were sent compared to the full listing.
+    """
+
+    def __init__(self, project_structure: Dict[str, List[str]], root_dir: str, mode: str = DEFAULT_CONTEXT_MODE):
+        self.root_dir = root_dir
+        self.mode = mode
+        self.full_listing = "\n".join([f"{subdir}:\n  " + "\n  ".join(files) for subdir, files in project_structure.items()])
+        self.full_tokens = estimate_tokens(self.full_listing)
+        self.folder_files = {}
+        for subdir, files in project_structure.items():
+            self.folder_files.setdefault(self.relative_folder(subdir), []).extend(os.path.basename(f) for f in files)
+        self.file_count = sum(len(files) for files in self.folder_files.values())
+        self.child_folders = {}
+        for folder in sorted(self.folder_files):
+            if folder != ".":
+                self.child_folders.setdefault(os.path.dirname(folder) or ".", []).append(folder)
+        self.local_sections = {}  # folder -> its part of the local context, shared by all components in it
+        self.shared_context = None
+        self.lock = threading.Lock()
+        self.prompt_count = 0
+        self.sent_tokens = 0
+
+    def relative_folder(self, folder: str) -> str:
+        return relative_to_root(folder, self.root_dir)
+
+    def build_tree(self) -> str:
+        lines = []
+        for folder in sorted(self.folder_files):
+            depth = 0 if folder == "." else folder.count("/") + 1
+            name = "./" if folder == "." else folder.rsplit("/", 1)[-1] + "/"
+            lines.append(f"{'  ' * max(0, depth - 1)}{name} {compress_file_names(self.folder_files[folder])}")
+        return "\n".join(lines)
+
+    def build_digest(self) -> str:
+        file_count = self.file_count
+        largest = sorted(self.folder_files.items(), key=lambda item: len(item[1]), reverse=True)[:DIGEST_MAX_FOLDERS]
+        extension_counts = {}
+        for files in self.folder_files.values():
+            for file_name in files:
+                extension = os.path.splitext(file_name)[1] or file_name
+                extension_counts[extension] = extension_counts.get(extension, 0) + 1
+        lines = [f"The project has {file_count} files in {len(self.folder_files)} folders.",
+                 "File types: " + ", ".join(f"{extension} ({count})" for extension, count in
+                                            sorted(extension_counts.items(), key=lambda item: item[1], reverse=True)),
+                 "Largest folders: " + ", ".join(f"{folder}/ ({len(files)} files)" for folder, files in largest)]
+        return "\n".join(lines)
+
+    def build_local_section(self, folder: str) -> str:
+        files = self.folder_files.get(folder, [])
+        listed = compress_file_names(files[:LOCAL_MAX_FILES])
+        if len(files) > LOCAL_MAX_FILES:
+            listed += f" and {len(files) - LOCAL_MAX_FILES} more files"
+        lines = [f"Files in {folder}/: {listed}"]
+
+        parent = os.path.dirname(folder) or "."
+        neighbours = [parent] if parent != folder and parent in self.folder_files else []
+        neighbours += self.child_folders.get(folder, []) if folder != parent else []
+        neighbours += [other for other in self.child_folders.get(parent, []) if other != folder and other not in neighbours]
+        if neighbours:
+            listed = ", ".join(f"{other}/ ({len(self.folder_files[other])} files)"
+                               for other in neighbours[:LOCAL_MAX_NEIGHBOURS])
+            if len(neighbours) > LOCAL_MAX_NEIGHBOURS:
+                listed += f" and {len(neighbours) - LOCAL_MAX_NEIGHBOURS} more folders"
+            lines.append(f"Neighbouring folders: {listed}")
+        return "\n".join(lines)
+
+    def build_local(self, file_paths: List[str]) -> str:
+        lines = []
+        for folder in sorted({self.relative_folder(os.path.dirname(fp)) for fp in file_paths}):
+            if folder not in self.local_sections:
+                self.local_sections[folder] = self.build_local_section(folder)
+            lines.append(self.local_sections[folder])
+        lines.append(f"The whole project has {self.file_count} files in {len(self.folder_files)} folders.")
+        return "\n".join(lines)
+
+    def for_component(self, file_paths: List[str]) -> str:
+        """Returns the project overview to include in the prompt for the given files."""
+        if self.mode == "local":
+            context = self.build_local(file_paths)
+        else:
+            with self.lock:
+                if self.shared_context is None:
+                    builders = {"full": lambda: self.full_listing, "tree": self.build_tree, "digest": self.build_digest}
+                    self.shared_context = builders[self.mode]()
+            context = self.shared_context
+        with self.lock:
+            self.prompt_count += 1
+            self.sent_tokens += estimate_tokens(context)
+        return context
+
+    def report(self):
+        """Prints how many tokens the context mode saved compared to sending the full file listing."""
+        if not self.prompt_count:
+            return
+        full_tokens = self.full_tokens * self.prompt_count
+        saved = full_tokens - self.sent_tokens
+        logger.info(f"Project context ({self.mode}): sent {self.sent_tokens} tokens in {self.prompt_count} prompts "
+                    f"instead of {full_tokens} with the full file listing, saving {saved} tokens "
+                    f"({100 * saved / max(full_tokens, 1):.1f}%).")
+
+
+def parse_pairing_rule(rule: str) -> Tuple[List[str], List[str]]:
+    """Parses a 'header/folder:source/folder' pairing rule into the folder segments of both sides."""
+    header_folder, separator, source_folder = rule.partition(":")
+    if not separator or not header_folder or not source_folder:
+        raise ValueError(f"Invalid pairing rule '{rule}', expected the form 'include:src'.")
+    return header_folder.strip("/").split("/"), source_folder.strip("/").split("/")
+
+
+def map_header_folder(header_folder: str, rule: Tuple[List[str], List[str]]) -> List[str]:
+    """Returns the source folders a pairing rule maps a header folder to (one per occurrence of the rule's folder)."""
+    header_parts, source_parts = rule
+    parts = [] if header_folder == "." else header_folder.split("/")
+    candidates = []
+    for i in range(len(parts) - len(header_parts) + 1):
+        if parts[i:i + len(header_parts)] == header_parts:
+            candidates.append("/".join(parts[:i] + source_parts + parts[i + len(header_parts):]))
+    return candidates
+
+
+def build_component_index(project_structure: Dict[str, List[str]], root_dir: str,
+                          pairing_rules: Optional[List[str]] = None, pair_unique_stems: bool = True) -> Dict[str, List[str]]:
+    """Builds the components of the whole project once, keyed by collision-free component IDs.
+
+    Files are first paired within their folder. Headers and sources left over are then paired across folders,
+    first with the pairing rules (e.g. 'include:src' pairs include/gfx/foo.h with src/gfx/foo.cpp), then, if
+    `pair_unique_stems` is set, if they are the only unpaired header and the only unpaired source with that name
+    in the whole project.
+    Component IDs are the folder relative to the root followed by the component name, e.g. 'src/gfx/foo'.
+    """
+    logger.info("Building the project-wide component index...")
+    rules = [parse_pairing_rule(rule) for rule in (DEFAULT_PAIRING_RULES if pairing_rules is None else pairing_rules)]
+    components = []  # (component ID, file paths) in discovery order
+    unpaired_headers = {}  # stem -> unpaired .h files
+    unpaired_sources = {}  # stem -> unpaired .cpp files
+
+    for subdir, files in project_structure.items():
+        folder = relative_to_root(subdir, root_dir)
+        prefix = "" if folder == "." else folder + "/"
+        paired_files = pair_header_and_source_files(files)
+
+        for name, file_paths in paired_files.items():
+            if name != "unpaired_files" and file_paths:
+                components.append((prefix + name, file_paths))
+
+        for file_path in paired_files.get("unpaired_files", []):
+            stem, extension = os.path.splitext(os.path.basename(file_path))
+            if extension == ".h":
+                unpaired_headers.setdefault(stem, []).append(file_path)
+            elif extension == ".cpp":
+                unpaired_sources.setdefault(stem, []).append(file_path)
+            else:
+                components.append((prefix + os.path.basename(file_path), [file_path]))
+
+    def merge_pair(stem: str, header: str, source: str):
+        unpaired_headers[stem].remove(header)
+        unpaired_sources[stem].remove(source)
+        header_folder = relative_to_root(os.path.dirname(header), root_dir)
+        prefix = "" if header_folder == "." else header_folder + "/"
+        components.append((prefix + stem, [header, source]))
+
+    # Only stems with exactly one header and one source in the whole project are unique, whatever the rules pair
+    unique_stems = [stem for stem, headers in unpaired_headers.items()
+                    if len(headers) == 1 and len(unpaired_sources.get(stem, [])) == 1]
+    merged_pairs = 0
+    for stem, headers in unpaired_headers.items():
+        sources = unpaired_sources.get(stem, [])
+        for header in list(headers):
+            header_folder = relative_to_root(os.path.dirname(header), root_dir)
+            source_folders = {folder for rule in rules for folder in map_header_folder(header_folder, rule)}
+            source = next((s for s in sources if relative_to_root(os.path.dirname(s), root_dir) in source_folders), None)
+            if source is not None:
+                merge_pair(stem, header, source)
+                merged_pairs += 1
+    if pair_unique_stems:
+        for stem in unique_stems:
+            if unpaired_headers[stem] and unpaired_sources[stem]:
+                merge_pair(stem, unpaired_headers[stem][0], unpaired_sources[stem][0])
+                merged_pairs += 1
+
+    for file_path in [f for files in unpaired_headers.values() for f in files] + \
+                     [f for files in unpaired_sources.values() for f in files]:
+        components.append((relative_to_root(file_path, root_dir), [file_path]))
+
+    component_index = {}
+    for component_id, file_paths in components:
+        unique_id = component_id
+        suffix = 2
+        while unique_id in component_index:
+            unique_id = f"{component_id}#{suffix}"
+            suffix += 1
+        component_index[unique_id] = file_paths
+
+    logger.info(f"Component index complete. {len(component_index)} components, {merged_pairs} header/source pairs merged "
+                f"across folders (saving {merged_pairs} requests).")
+    return component_index
+
+
+@timed("read_file")
 def read_file(file_path: str) -> str:
     """Reads the content of a file."""
-    print(f"Reading file: {file_path}")
+    logger.debug(f"Reading file: {file_path}")
     with open(file_path, "r", encoding="utf-8") as file:
         return file.read()
 
@@ -155,10 +1501,195 @@ def should_lower_relevance_due_to_tests(file_path: str, file_content: str) -> bo
     """Determines if a file is likely a test file and should have lower relevance."""
     is_test_file = 'test' in os.path.basename(file_path).lower() and 'main' in file_content.lower()
     if is_test_file:
-        print(f"File {file_path} identified as a test file.")
+        logger.debug(f"File {file_path} identified as a test file.")
     return is_test_file
 
 
+C_SYNTAX_PATTERN = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<raw_string>R"(?P<delimiter>[^()\\\s]{0,16})\(.*?\)(?P=delimiter)")
+    |(?P<string>"(?:\\.|[^"\\\n])*")
+    |(?P<char>'(?:\\.|[^'\\\n])*')
+    |(?P<preprocessor>^[ \t]*\#(?:\\\n|[^\n])*)
+    |(?P<brace>[{};])
+""", re.DOTALL | re.MULTILINE | re.VERBOSE)
+FUNCTION_HEADER_PATTERN = re.compile(
+    r"\)\s*(?:(?:const|override|final|noexcept|volatile|mutable|&&?|(?:noexcept|throw)\s*\([^)]*\))\s*)*"
+    r"(?:->\s*[^{;]+)?$")
+# A constructor's member initializer list, e.g. `Foo::Foo(int a) : a_(a), b_{a}`
+INITIALIZER_LIST_PATTERN = re.compile(r"\)\s*(?:noexcept\s*)?:(?!:)")
+
+
+def configure_preprocessing(enabled: bool, max_body_tokens: int):
+    """Sets how the files are preprocessed before they are sent."""
+    global PREPROCESS, MAX_BODY_TOKENS
+    PREPROCESS = enabled
+    MAX_BODY_TOKENS = max_body_tokens
+
+
+def preprocessing_signature() -> str:
+    """Describes the preprocessing settings, so summaries of differently preprocessed files aren't mixed up."""
+    return f"preprocess:{PREPROCESS_VERSION}:{MAX_BODY_TOKENS}"
+
+
+def strip_license_banner(content: str, line_comment: str = "//") -> str:
+    """Removes the comment blocks at the top of a file that contain a license or copyright notice."""
+    rest = content.lstrip()
+    while True:
+        if line_comment == "//" and rest.startswith("/*"):
+            end = rest.find("*/")
+            end = len(rest) if end < 0 else end + 2
+        elif rest.startswith(line_comment):
+            match = re.match(rf"(?:[ \t]*{re.escape(line_comment)}[^\n]*(?:\n|$))+", rest)
+            end = match.end()
+        else:
+            return rest
+        if not LICENSE_PATTERN.search(rest[:end]):
+            return rest
+        rest = rest[end:].lstrip()
+
+
+def collapse_whitespace(content: str) -> str:
+    """Removes trailing whitespace and collapses runs of blank lines into one."""
+    lines = [line.rstrip() for line in content.splitlines()]
+    collapsed = []
+    for line in lines:
+        if line or (collapsed and collapsed[-1]):
+            collapsed.append(line)
+    return "\n".join(collapsed).strip("\n") + "\n"
+
+
+def normalize_header(header: str) -> str:
+    """Removes comments and preprocessor lines from the code before a `{` and collapses its whitespace."""
+    header = re.sub(r"//[^\n]*|/\*.*?\*/|^[ \t]*#[^\n]*", "", header, flags=re.DOTALL | re.MULTILINE)
+    return " ".join(header.split())
+
+
+def is_elidable_header(header: str) -> bool:
+    """Checks whether the code before a `{` starts a function body or an initializer rather than a declaration scope."""
+    header = normalize_header(header)
+    if INITIALIZER_LIST_PATTERN.search(header) and header.endswith("}"):
+        # A constructor whose initializer list ends with a braced member initializer
+        return True
+    return bool(header) and (header.endswith("=") or bool(FUNCTION_HEADER_PATTERN.search(header)))
+
+
+def is_member_initializer(header: str) -> bool:
+    """Checks whether a `{` opens a braced member initializer in a constructor's initializer list, e.g. `b_{a}`."""
+    header = normalize_header(header)
+    return bool(INITIALIZER_LIST_PATTERN.search(header)) and bool(re.search(r"[\w>]$", header))
+
+
+def find_elidable_blocks(content: str) -> List[Tuple[int, int]]:
+    """Finds the outermost function bodies and initializers of C-like code as (`{` index, `}` index) pairs.
+
+    A lightweight scan that skips comments, strings and preprocessor lines and looks at the code before each `{`:
+    scopes like namespaces, classes and enums are entered, bodies whose header ends like a function signature
+    (or initializers after `=`) are recorded whole. Braced member initializers of a constructor stay part of its
+    header.
+    """
+    blocks = []
+    header_start = 0
+    body_start = None
+    depth = 0
+    initializer_depth = 0
+    for match in C_SYNTAX_PATTERN.finditer(content):
+        brace = match.group("brace")
+        if not brace:
+            continue
+        position = match.start()
+        if body_start is not None:
+            depth += {"{": 1, "}": -1}.get(brace, 0)
+            if depth == 0:
+                blocks.append((body_start, position))
+                body_start = None
+                header_start = position + 1
+        elif initializer_depth:
+            initializer_depth += {"{": 1, "}": -1}.get(brace, 0)
+        elif brace == "{" and is_elidable_header(content[header_start:position]):
+            body_start = position
+            depth = 1
+        elif brace == "{" and is_member_initializer(content[header_start:position]):
+            initializer_depth = 1
+        else:
+            header_start = position + 1
+    return blocks
+
+
+def elide_body(body: str, max_tokens: int) -> str:
+    """Keeps the first lines of a body up to `max_tokens` tokens and replaces the rest with a note."""
+    lines = body.split("\n")
+    # The last line is the indentation of the closing brace if that is on a line of its own
+    closing = lines.pop() if len(lines) > 1 and not lines[-1].strip() else ""
+    kept = []
+    kept_tokens = 0
+    for line in lines:
+        line_tokens = estimate_tokens(line)
+        if kept_tokens + line_tokens > max_tokens:
+            break
+        kept.append(line)
+        kept_tokens += line_tokens
+    elided = [line for line in lines[len(kept):] if line.strip()]
+    if not elided:
+        return body
+    indent = re.match(r"\s*", elided[0]).group(0)
+    note = f"{indent}/* ... {len(elided)} more line{'s' if len(elided) > 1 else ''} */"
+    return "\n".join(kept + [note, closing]) if closing or len(lines) > 1 else f" {note.strip()} "
+
+
+def elide_large_blocks(content: str, max_tokens: int) -> str:
+    """Shortens function bodies and initializers with more than `max_tokens` tokens, keeping all signatures."""
+    parts = []
+    last = 0
+    for open_index, close_index in find_elidable_blocks(content):
+        body = content[open_index + 1:close_index]
+        body_tokens = estimate_tokens(body)
+        if body_tokens <= max_tokens:
+            continue
+        elided_body = elide_body(body, max_tokens)
+        # The note itself takes a few tokens, short bodies are kept if it doesn't pay off
+        if estimate_tokens(elided_body) < body_tokens:
+            parts.append(content[last:open_index + 1])
+            parts.append(elided_body)
+            last = close_index
+    parts.append(content[last:])
+    return "".join(parts)
+
+
+def preprocess_source(file_name: str, content: str) -> str:
+    """Shrinks a source file before it is sent: removes license banners and redundant whitespace and, for C-like
+    files, cuts large function bodies and initializers down to MAX_BODY_TOKENS while keeping every declaration."""
+    if file_name == "CMakeLists.txt" or file_name.endswith(".cmake"):
+        return collapse_whitespace(strip_license_banner(content, "#"))
+    content = strip_license_banner(content)
+    if MAX_BODY_TOKENS > 0:
+        content = elide_large_blocks(content, MAX_BODY_TOKENS)
+    return collapse_whitespace(content)
+
+
+COMPONENT_SUMMARY_SYSTEM_MESSAGE = (
+    "You are an AI assistant specialized in summarizing code files. "
+    "Please format the summaries with consistent markdown, including: "
+    "### Filename(s), #### Overview, #### Public Interface, #### Implementation."
+)
+
+COMPONENT_SUMMARY_INSTRUCTIONS = (
+    "Please provide a detailed summary. Start with a detailed overview, then describe the public interface in detail, "
+    "and finally explain the inner workings of the file(s). For the inner workings, also explain how the code is "
+    "implemented (mostly in words and avoid code snippets as much as possible)."
+    "It should be structured into 4 sections: ## (this title has to be the filename(s) without the path and "
+    "if there are several files they should be formatted like this 'file1 & file2' and neither the word "
+    "filename nor title should appear in this section), ### Overview, "
+    "### Public Interface, and ### Implementation."
+    "After the summary, always assign a relevance score from 1 to 10 indicating its importance to the overall project "
+    "(1 being not important, 10 being critically important). Be especially critical and try to assign lower scores "
+    "unless the file(s) are crucial to the main functionality of the project. The main file itself should "
+    "always have a score of 10. The CMakeLists.txt always a score of 0"
+    "Format the relevance score exactly like this: [Relevance score: 7] but don't mention the relevance otherwise"
+    "and don't add a title called Relevance, it should only be the score within the square brackets.\n\n"
+)
+
+
 def create_component_summary_prompt(file_names: List[str], file_content: str, project_overview: str, is_test_file: bool) -> str:
     """Creates a prompt for summarizing code files with consistent formatting."""
     if not file_names:
@@ -170,19 +1701,7 @@ def create_component_summary_prompt(file_names: List[str], file_content: str, pr
     base_prompt = (
         f"Here is an overview of the project structure:\n{project_overview}\n\n"
         f"{file_intro}"
-        "Please provide a detailed summary. Start with a detailed overview, then describe the public interface in detail, "
-        "and finally explain the inner workings of the file(s). For the inner workings, also explain how the code is "
-        "implemented (mostly in words and avoid code snippets as much as possible)."
-        "It should be structured into 4 sections: ## (this title has to be the filename(s) without the path and "
-        "if there are several files they should be formatted like this 'file1 & file2' and neither the word "
-        "filename nor title should appear in this section), ### Overview, "
-        "### Public Interface, and ### Implementation."
-        "After the summary, always assign a relevance score from 1 to 10 indicating its importance to the overall project "
-        "(1 being not important, 10 being critically important). Be especially critical and try to assign lower scores "
-        "unless the file(s) are crucial to the main functionality of the project. The main file itself should "
-        "always have a score of 10. The CMakeLists.txt always a score of 0"
-        "Format the relevance score exactly like this: [Relevance score: 7] but don't mention the relevance otherwise"
-        "and don't add a title called Relevance, it should only be the score within the square brackets.\n\n"
+        f"{COMPONENT_SUMMARY_INSTRUCTIONS}"
         f"{file_content}"
     )
 
@@ -192,77 +1711,731 @@ def create_component_summary_prompt(file_names: List[str], file_content: str, pr
     return base_prompt
 
 
+def create_chunk_summary_prompt(file_names: List[str], chunk: str, chunk_index: int, chunk_count: int) -> str:
+    """Creates a prompt for summarizing one chunk of a component that is too large for a single request."""
+    return (
+        f"The following is part {chunk_index + 1} of {chunk_count} of the code files named {', '.join(file_names)}. "
+        "Describe every class, function, variable and macro it declares or defines: what it is for, its signature "
+        "or public members, and how it is implemented (mostly in words and avoid code snippets as much as possible). "
+        "This partial summary will be merged with the summaries of the other parts, so don't add an introduction, "
+        "a conclusion or a relevance score.\n\n"
+        f"{chunk}"
+    )
+
+
+def create_component_merge_prompt(file_names: List[str], partial_summaries: List[str], project_overview: str,
+                                  is_test_file: bool) -> str:
+    """Creates a prompt that merges the partial summaries of a chunked component into the regular summary format."""
+    partials = "\n\n".join(f"Part {index + 1}:\n{summary}" for index, summary in enumerate(partial_summaries))
+    prompt = (
+        f"Here is an overview of the project structure:\n{project_overview}\n\n"
+        f"The code files named {', '.join(file_names)} were too large to summarize at once. The following are "
+        "summaries of consecutive parts of them, merge them into a single summary of the files.\n\n"
+        f"{COMPONENT_SUMMARY_INSTRUCTIONS}"
+        f"{partials}"
+    )
+
+    if is_test_file:
+        prompt += "\n\nNote: This file appears to be a test file."
+
+    return prompt
+
+
+def split_into_blocks(content: str) -> List[str]:
+    """Splits code into top-level blocks, cutting only where the brace depth is zero.
+
+    Blocks end after a line that closes a top-level brace (the end of a function, class or namespace body)
+    or at a blank line outside of any braces, so functions and classes are never cut in half.
+    """
+    blocks = []
+    current = []
+    depth = 0
+    for line in content.splitlines(keepends=True):
+        current.append(line)
+        opened = line.count("{") - line.count("}")
+        closes_block = depth > 0 and depth + opened <= 0
+        depth = max(0, depth + opened)
+        if depth == 0 and (closes_block or not line.strip()):
+            blocks.append("".join(current))
+            current = []
+    if current:
+        blocks.append("".join(current))
+    return blocks
+
+
+def split_into_chunks(file_names: List[str], file_contents: List[str], max_tokens: int) -> List[str]:
+    """Packs the top-level blocks of the files into chunks of at most `max_tokens` (estimated) tokens.
+
+    Blocks that are larger than a chunk on their own are split at line boundaries.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            chunks.append("".join(current))
+        current, current_tokens = [], 0
+
+    for file_name, content in zip(file_names, file_contents):
+        pieces = [f"/* File: {file_name} */\n"]
+        for block in split_into_blocks(content):
+            if estimate_tokens(block) <= max_tokens:
+                pieces.append(block)
+            else:
+                pieces.extend(block.splitlines(keepends=True))
+
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                flush()
+            current.append(piece)
+            current_tokens += piece_tokens
+    flush()
+    return chunks
+
+
+def summarize_oversized_component(file_names: List[str], file_contents: List[str], project_overview: str,
+                                  is_test_file: bool, max_prompt_tokens: int) -> str:
+    """Summarizes a component that doesn't fit into one request: chunks are summarized in parallel, then merged."""
+    chunk_tokens = max(MIN_CHUNK_TOKENS, max_prompt_tokens - estimate_tokens(create_chunk_summary_prompt(file_names, "", 0, 1)))
+    chunks = split_into_chunks(file_names, file_contents, chunk_tokens)
+    logger.info(f"Files {', '.join(file_names)} exceed {max_prompt_tokens} tokens. Summarizing {len(chunks)} chunks...")
+
+    def summarize(prompt: str) -> str:
+        return create_chat_completion(component_summary_messages(prompt), f"{', '.join(file_names)} (part)").content
+
+    with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_CONCURRENT_REQUESTS)) as executor:
+        partial_summaries = list(executor.map(
+            summarize, [create_chunk_summary_prompt(file_names, chunk, index, len(chunks)) for index, chunk in enumerate(chunks)]
+        ))
+
+    # Merge partial summaries in groups until the final merge fits into a single request
+    while len(partial_summaries) > 1 and estimate_tokens(
+            create_component_merge_prompt(file_names, partial_summaries, project_overview, is_test_file)) > max_prompt_tokens:
+        groups = split_into_chunks([f"{', '.join(file_names)} (partial summaries)"], ["\n\n".join(partial_summaries)], chunk_tokens)
+        if len(groups) >= len(partial_summaries):
+            break
+        logger.info(f"Condensing {len(partial_summaries)} partial summaries into {len(groups)}...")
+        with ThreadPoolExecutor(max_workers=min(len(groups), MAX_CONCURRENT_REQUESTS)) as executor:
+            partial_summaries = list(executor.map(
+                summarize, [create_chunk_summary_prompt(file_names, group, index, len(groups)) for index, group in enumerate(groups)]
+            ))
+
+    return summarize(create_component_merge_prompt(file_names, partial_summaries, project_overview, is_test_file))
+
+
 def extract_relevance_score(summary: str) -> float:
     """Extracts the relevance score from the summary using regular expressions for robustness."""
     match = re.search(r'Relevance score:\s*(\d+)', summary)
     relevance = float(match.group(1)) if match else 5.0
-    print(f"Extracted relevance score: {relevance}")
+    logger.debug(f"Extracted relevance score: {relevance}")
     return relevance
 
 
-def summarize_component_files(file_paths: List[str], file_contents: List[str], results: Dict[str, Dict[str, Any]], project_overview: str) -> Tuple[str, float]:
-    """Uses OpenAI to summarize the combined content of related files and assign a relevance score."""
-    if not file_paths or not file_contents:
-        print(f"file_paths: {file_paths}")  # Debugging statement
-        print(f"file_contents: {file_contents}")  # Debugging statement
-        raise ValueError("file_paths or file_contents is empty. Cannot summarize without valid file paths and contents.")
+def hash_text(text: str) -> str:
+    """Returns the SHA-256 hex digest of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_stat_signature(file_path: str) -> Tuple[int, int]:
+    """Returns the size and modification time of a file, used to decide whether it has to be hashed again."""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def component_content_hash(file_names: List[str], file_hashes: List[str]) -> str:
+    """Derives the cache key of a component from its file names and contents, the model, the prompt version and
+    the preprocessing settings."""
+    parts = [MODEL, str(PROMPT_VERSION)] + ([preprocessing_signature()] if PREPROCESS else [])
+    parts += [f"{name}:{file_hash}" for name, file_hash in zip(file_names, file_hashes)]
+    return hash_text("\n".join(parts))
+
+
+def is_unchanged_by_stat(stored_data: Dict[str, Any], file_paths: List[str], file_names: List[str],
+                         file_stats: List[Tuple[int, int]]) -> bool:
+    """Checks whether a stored summary is fresh without reading the files, using the sizes and modification times."""
+    stored_files = stored_data.get('files', [])
+    if [(f['path'], f['size'], f['mtime_ns']) for f in stored_files] != [(fp, *stat) for fp, stat in zip(file_paths, file_stats)]:
+        return False
+    file_hashes = [f['sha256'] for f in stored_files]
+    return stored_data.get('content_hash') == component_content_hash(file_names, file_hashes)
+
+
+def component_summary_messages(prompt: str) -> List[Dict[str, str]]:
+    """Returns the chat messages for a component summary prompt."""
+    return [
+        {
+            "role": "system",
+            "content": COMPONENT_SUMMARY_SYSTEM_MESSAGE
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+@timed("prepare_component_summary")
+def prepare_component_summary(file_paths: List[str], results: ResultsStore, project_context: ProjectContext,
+                              max_prompt_tokens: int = MAX_PROMPT_TOKENS
+                              ) -> Tuple[Optional[Tuple[str, float]], Optional[Dict[str, Any]]]:
+    """Looks up the summary of a component in the cache and prepares the request if it has to be (re)generated.
+
+    Summaries are cached under the content hash of the files. Files whose size and modification time match
+    the cache are not read at all, other files are hashed and only summarized if their content changed.
+    Returns the cached (summary, relevance) and None on a cache hit, otherwise None and the pending request.
+    """
+    if not file_paths:
+        raise ValueError("file_paths is empty. Cannot summarize without valid file paths.")
 
     file_paths = sorted(file_paths)
     file_key = '|'.join(file_paths)
     file_names = [os.path.basename(fp) for fp in file_paths]
-    combined_content = "\n\n".join(file_contents)
+    file_stats = [file_stat_signature(fp) for fp in file_paths]
+
+    stored_data = results.get(file_key)
+    if stored_data and is_unchanged_by_stat(stored_data, file_paths, file_names, file_stats):
+        logger.debug(f"Summary for {file_key} is up to date. Skipping...")
+        run_stats.record_cache_lookup(file_key, True)
+        return (stored_data['summary'], stored_data['relevance']), None
+
+    file_contents = [read_file(fp) for fp in file_paths]
+    file_hashes = [hash_text(fc) for fc in file_contents]
+    content_hash = component_content_hash(file_names, file_hashes)
+    record = {
+        'content_hash': content_hash,
+        'model': MODEL,
+        'prompt_version': PROMPT_VERSION,
+        'files': [{'path': fp, 'size': size, 'mtime_ns': mtime_ns, 'sha256': file_hash}
+                  for fp, (size, mtime_ns), file_hash in zip(file_paths, file_stats, file_hashes)],
+    }
 
-    # Get current last modified times
-    current_mtimes = [os.path.getmtime(fp) for fp in file_paths]
+    # Records written before content hashing only have modification times, accept them if those still match
+    legacy_mtimes = [os.path.getmtime(fp) for fp in file_paths]
+    if stored_data and (stored_data.get('content_hash') == content_hash or
+                        stored_data.get('last_modified_times') == legacy_mtimes):
+        cached_data = stored_data
+    else:
+        cached_data = results.find_by_content_hash(content_hash)
+
+    if cached_data:
+        logger.debug(f"Content of {file_key} is unchanged. Reusing cached summary...")
+        run_stats.record_cache_lookup(file_key, True)
+        save_intermediate_results(results, file_key, {
+            'summary': cached_data['summary'],
+            'relevance': cached_data['relevance'],
+            **record,
+        })
+        return (cached_data['summary'], cached_data['relevance']), None
+
+    previous = None
+    if stored_data:
+        logger.debug(f"Files for {file_key} have been modified. Regenerating summary.")
+        if 'summary' in stored_data:
+            previous = (stored_data['summary'], stored_data['relevance'])
+    run_stats.record_cache_lookup(file_key, False)
 
-    if file_key in results:
-        stored_data = results[file_key]
-        stored_last_modified_times = stored_data.get('last_modified_times', [])
+    is_test_file = any(should_lower_relevance_due_to_tests(fp, fc) for fp, fc in zip(file_paths, file_contents))
+    tokens_before = sum(estimate_tokens(fc) for fc in file_contents)
+    if PREPROCESS:
+        file_contents = [preprocess_source(name, fc) for name, fc in zip(file_names, file_contents)]
+    tokens_after = sum(estimate_tokens(fc) for fc in file_contents)
+    run_stats.record_preprocessing(file_key, tokens_before, tokens_after)
+
+    combined_content = f"/* Combined files: {', '.join(file_names)} */\n\n" + "\n\n".join(file_contents)
+    project_overview = project_context.for_component(file_paths)
+    prompt = create_component_summary_prompt(file_names, combined_content, project_overview, is_test_file)
 
-        if stored_last_modified_times == current_mtimes:
-            print(f"Summary for {file_key} is up to date. Skipping...")
-            return stored_data['summary'], stored_data['relevance']
-        else:
-            print(f"Files for {file_key} have been modified. Regenerating summary.")
+    return None, {
+        'file_key': file_key,
+        'file_names': file_names,
+        'file_contents': file_contents,
+        'record': record,
+        'project_overview': project_overview,
+        'is_test_file': is_test_file,
+        'prompt': prompt,
+        'oversized': estimate_tokens(prompt) > max_prompt_tokens,
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'previous': previous,
+    }
 
-    print(f"Summarizing files: {', '.join(file_names)}")
-    combined_content = f"/* Combined files: {', '.join(file_names)} */\n\n" + combined_content
 
-    is_test_file = any(should_lower_relevance_due_to_tests(fp, fc) for fp, fc in zip(file_paths, file_contents))
-    prompt = create_component_summary_prompt(file_names, combined_content, project_overview, is_test_file)
+@timed("request_component_summary")
+def request_component_summary(request: Dict[str, Any], max_prompt_tokens: int = MAX_PROMPT_TOKENS) -> str:
+    """Sends a prepared component summary request, chunking it if it is too large for a single request."""
+    logger.info(f"Summarizing files: {', '.join(request['file_names'])} "
+                f"({request['tokens_before']} tokens, {request['tokens_after']} after preprocessing)")
+    if request['oversized']:
+        return summarize_oversized_component(request['file_names'], request['file_contents'], request['project_overview'],
+                                             request['is_test_file'], max_prompt_tokens)
+    return create_chat_completion(component_summary_messages(request['prompt']), request['file_key']).content
 
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an AI assistant specialized in summarizing code files. "
-                           "Please format the summaries with consistent markdown, including: "
-                           "### Filename(s), #### Overview, #### Public Interface, #### Implementation."
-            },
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ]
-    )
-    summary = completion.choices[0].message.content
+
+def store_component_summary(results: ResultsStore, request: Dict[str, Any], summary: str) -> Tuple[str, float]:
+    """Extracts the relevance score of a new summary and stores both with the content hash and file stats."""
     relevance = extract_relevance_score(summary)
-    # Store the summary, relevance, and current_mtimes in results
-    results[file_key] = {
+    save_intermediate_results(results, request['file_key'], {
         'summary': summary,
         'relevance': relevance,
-        'last_modified_times': current_mtimes,
-    }
-    save_intermediate_results(results)
+        **request['record'],
+    })
     return summary, relevance
 
 
+def predicted_relevance(request: Dict[str, Any]) -> float:
+    """Predicts the relevance of a pending component: its previous score, or a guess from the file names."""
+    if request['previous']:
+        return request['previous'][1]
+    stems = [os.path.splitext(name)[0].lower() for name in request['file_names']]
+    if "main" in stems:
+        return MAIN_FILE_RELEVANCE
+    if "CMakeLists.txt" in request['file_names']:
+        return BUILD_FILE_RELEVANCE
+    if request['is_test_file']:
+        return TEST_FILE_RELEVANCE
+    return PREDICTED_RELEVANCE
+
+
+def summary_priority(request: Dict[str, Any]) -> Tuple[float, int]:
+    """Orders pending components by predicted relevance, then larger components first."""
+    return predicted_relevance(request), sum(file['size'] for file in request['record']['files'])
+
+
+def estimate_request_tokens(request: Dict[str, Any], max_prompt_tokens: int = MAX_PROMPT_TOKENS) -> int:
+    """Estimates the tokens a component summary will use, including the partial summaries of chunked components."""
+    prompt_tokens = estimate_tokens(request['prompt'])
+    completions = 1 + (prompt_tokens // max_prompt_tokens + 1 if request['oversized'] else 0)
+    return prompt_tokens + completions * EXPECTED_COMPLETION_TOKENS
+
+
+def summarize_components(components: List[Tuple[str, List[str]]], results: ResultsStore, project_context: ProjectContext,
+                         max_workers: int, max_prompt_tokens: int = MAX_PROMPT_TOKENS, budget: Optional[Budget] = None
+                         ) -> Tuple[Dict[str, Tuple[str, float]], set]:
+    """Summarizes the given (name, file_paths) components concurrently using up to `max_workers` threads.
+
+    Cached summaries are looked up first. The components that need a new summary are then requested most relevant
+    first (see `summary_priority`) while the `budget` lasts. Components left over keep their previous summary if
+    they have one. Returns the summaries and the names of the components whose summary is outdated.
+    """
+    logger.info(f"Summarizing {len(components)} components with up to {max_workers} concurrent requests...")
+
+    def prepare(file_paths: List[str]) -> Optional[Tuple[Optional[Tuple[str, float]], Optional[Dict[str, Any]]]]:
+        existing_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
+        if not existing_paths:
+            logger.warning(f"No content found for files {file_paths}. Skipping...")
+            return None
+        return prepare_component_summary(existing_paths, results, project_context, max_prompt_tokens)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        prepared = list(executor.map(prepare, [file_paths for _, file_paths in components]))
+
+    summaries = {}
+    pending = []
+    for (name, _), preparation in zip(components, prepared):
+        if preparation is None:
+            continue
+        cached, request = preparation
+        if cached:
+            summaries[name] = cached
+        else:
+            pending.append((name, request))
+    pending.sort(key=lambda item: summary_priority(item[1]), reverse=True)
+    if pending:
+        logger.info(f"{len(pending)} components need a new summary, starting with the most relevant.")
+
+    def summarize(request: Dict[str, Any]) -> Optional[Tuple[str, float]]:
+        estimated_tokens = estimate_request_tokens(request, max_prompt_tokens)
+        if budget is not None and not budget.reserve(estimated_tokens):
+            return None
+        try:
+            return store_component_summary(results, request, request_component_summary(request, max_prompt_tokens))
+        finally:
+            if budget is not None:
+                budget.release(estimated_tokens)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(name, request, executor.submit(summarize, request)) for name, request in pending]
+
+    stale = set()
+    missing = 0
+    for name, request, future in futures:
+        result = future.result()
+        if result is not None:
+            summaries[name] = result
+        elif request['previous']:
+            summaries[name] = request['previous']
+            stale.add(name)
+        else:
+            missing += 1
+    if budget is not None and budget.exhausted:
+        run_stats.record_unfinished(budget.exhausted, len(stale), missing)
+    # In the order of the components, not the order in which they were requested
+    return {name: summaries[name] for name, _ in components if name in summaries}, stale
+
+
+MINHASH_EMPTY_BIN = 1 << 32
+
+
+def minhash_signature(text: str) -> List[int]:
+    """Returns the one-permutation MinHash signature of the token shingles of a text.
+
+    Each shingle is hashed once; the hash picks one of DEDUP_MINHASH_BINS bins, which keeps the smallest value.
+    """
+    tokens = TOKEN_PATTERN.findall(text)
+    signature = [MINHASH_EMPTY_BIN] * DEDUP_MINHASH_BINS
+    for index in range(max(1, len(tokens) - DEDUP_SHINGLE_TOKENS + 1)):
+        shingle_hash = zlib.crc32(" ".join(tokens[index:index + DEDUP_SHINGLE_TOKENS]).encode("utf-8"))
+        bin_index, value = shingle_hash % DEDUP_MINHASH_BINS, shingle_hash // DEDUP_MINHASH_BINS
+        if value < signature[bin_index]:
+            signature[bin_index] = value
+    return signature
+
+
+def estimate_similarity(signature: List[int], other: List[int]) -> float:
+    """Estimates the Jaccard similarity of the shingles behind two signatures, ignoring bins empty in both."""
+    both_empty = sum(map(MINHASH_EMPTY_BIN.__eq__, map(max, signature, other)))
+    compared = len(signature) - both_empty
+    return (sum(map(operator.eq, signature, other)) - both_empty) / compared if compared else 0.0
+
+
+class FileFingerprints:
+    """Content hash, token count and MinHash signature of files, recomputed only when their size or mtime change.
+
+    With a results store, the fingerprints (and the diffs of near-duplicates) are kept there as well, so later
+    runs don't read unchanged files either. New records are written by `save`.
+    """
+
+    def __init__(self, results: Optional[ResultsStore] = None):
+        self.results = results
+        self.lock = threading.Lock()
+        self.fingerprints = {}  # file path -> (stat signature, sha256, tokens, signature)
+        self.unsaved = {}  # results key -> record
+
+    def load(self, file_path: str) -> Optional[Tuple[Tuple[int, int], str, int, List[int]]]:
+        record = self.results.get(FINGERPRINT_KEY_PREFIX + file_path) if self.results is not None else None
+        if not record or record.get('version') != DEDUP_FINGERPRINT_VERSION:
+            return None
+        return (record['size'], record['mtime_ns']), record['sha256'], record['tokens'], record['minhash']
+
+    def get(self, file_path: str) -> Tuple[str, int, List[int]]:
+        stat = file_stat_signature(file_path)
+        with self.lock:
+            cached = self.fingerprints.get(file_path)
+        if cached is None:
+            cached = self.load(file_path)
+        if cached and cached[0] == stat:
+            with self.lock:
+                self.fingerprints[file_path] = cached
+            return cached[1:]
+        content = read_file(file_path)
+        fingerprint = (hash_text(content), estimate_tokens(content), minhash_signature(content))
+        with self.lock:
+            self.fingerprints[file_path] = (stat,) + fingerprint
+            self.unsaved[FINGERPRINT_KEY_PREFIX + file_path] = {
+                'version': DEDUP_FINGERPRINT_VERSION, 'size': stat[0], 'mtime_ns': stat[1],
+                'sha256': fingerprint[0], 'tokens': fingerprint[1], 'minhash': fingerprint[2],
+            }
+        return fingerprint
+
+    def duplicate_diff(self, representative_paths: List[str], file_paths: List[str], root_dir: str) -> str:
+        """Returns the `duplicate_diff_note` of a near-duplicate, reusing the stored one while both are unchanged."""
+        key = DUPLICATE_DIFF_KEY_PREFIX + "\n".join(file_paths)
+        inputs_hash = hash_text(json.dumps([[(path, self.get(path)[0]) for path in representative_paths],
+                                            [(path, self.get(path)[0]) for path in file_paths]]))
+        with self.lock:
+            record = self.unsaved.get(key)
+        if record is None and self.results is not None:
+            record = self.results.get(key)
+        if record and record['inputs_hash'] == inputs_hash:
+            return record['diff']
+        diff = duplicate_diff_note(representative_paths, file_paths, root_dir)
+        with self.lock:
+            self.unsaved[key] = {'inputs_hash': inputs_hash, 'diff': diff}
+        return diff
+
+    def save(self):
+        """Writes the fingerprints and diffs computed since the last call to the results store."""
+        with self.lock:
+            unsaved, self.unsaved = self.unsaved, {}
+        if unsaved and self.results is not None:
+            self.results.put_many(unsaved)
+
+
+def component_shape(file_paths: List[str]) -> Tuple[str, ...]:
+    """The file types of a component. Only components of the same shape are compared."""
+    return tuple(sorted(os.path.splitext(os.path.basename(file_path))[1] or os.path.basename(file_path)
+                        for file_path in file_paths))
+
+
+def duplicate_diff_note(representative_paths: List[str], file_paths: List[str], root_dir: str) -> str:
+    """Returns a unified diff of a near-duplicate against its representative, cut off after DEDUP_DIFF_MAX_LINES."""
+    def by_type(paths: List[str]) -> List[str]:
+        return sorted(paths, key=lambda path: component_shape([path]))
+
+    lines = []
+    for representative_path, file_path in zip(by_type(representative_paths), by_type(file_paths)):
+        lines.extend(difflib.unified_diff(read_file(representative_path).splitlines(), read_file(file_path).splitlines(),
+                                          relative_to_root(representative_path, root_dir),
+                                          relative_to_root(file_path, root_dir), n=0, lineterm=""))
+    if len(lines) > DEDUP_DIFF_MAX_LINES:
+        lines = lines[:DEDUP_DIFF_MAX_LINES] + [f"... ({len(lines) - DEDUP_DIFF_MAX_LINES} more lines)"]
+    return "\n".join(lines)
+
+
+@timed("deduplicate_components")
+def deduplicate_components(components: List[Tuple[str, List[str]]], root_dir: str,
+                           fingerprints: Optional[FileFingerprints] = None,
+                           threshold: float = NEAR_DUPLICATE_THRESHOLD,
+                           max_workers: int = MAX_CONCURRENT_REQUESTS) -> Tuple[List[Tuple[str, List[str]]], Dict[str, Dict[str, Any]]]:
+    """Groups identical and near-identical components so only one representative per group has to be summarized.
+
+    Exact copies are grouped by the content hash of their files, near-duplicates of the same shape by the estimated
+    similarity of their MinHash signatures. The first component of a group (by name) is its representative.
+    Returns the representatives and, for every other component, its representative and a note on how it differs.
+    Fingerprints are kept in memory only unless `fingerprints` was created with a results store.
+    """
+    fingerprints = fingerprints or FileFingerprints()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        component_fingerprints = dict(zip(
+            [name for name, _ in components],
+            executor.map(lambda component: [fingerprints.get(path) for path in component[1]], components)
+        ))
+
+    representatives = []
+    duplicates = {}
+    exact_groups = {}  # (shape, file hashes) -> representative
+    lsh_buckets = {}  # (shape, band, band values) -> representatives
+    representative_signatures = {}
+    rows = DEDUP_MINHASH_BINS // DEDUP_LSH_BANDS
+    component_files = dict(components)
+
+    for name, file_paths in sorted(components):
+        shape = component_shape(file_paths)
+        file_fingerprints = component_fingerprints[name]
+        exact_key = (shape, tuple(sorted(content_hash for content_hash, _, _ in file_fingerprints)))
+        if exact_key in exact_groups:
+            representative = exact_groups[exact_key]
+            duplicates[name] = {'representative': representative, 'similarity': 1.0,
+                                'note': f"Identical copy of `{representative}`, see its summary."}
+            continue
+
+        signature = None
+        if sum(tokens for _, tokens, _ in file_fingerprints) >= DEDUP_MIN_TOKENS:
+            # The signature of the union of the shingles of all files is the element-wise minimum
+            signature = [min(values) for values in zip(*(file_signature for _, _, file_signature in file_fingerprints))]
+            bands = [(shape, band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(DEDUP_LSH_BANDS)]
+            bands = [band for band in bands if any(value != MINHASH_EMPTY_BIN for value in band[2])]
+            candidates = Counter(candidate for band in bands for candidate in lsh_buckets.get(band, []))
+            best = max(((estimate_similarity(signature, representative_signatures[candidate]), candidate)
+                        for candidate, _ in candidates.most_common(DEDUP_MAX_CANDIDATES)), default=(0.0, None))
+            if best[0] >= threshold:
+                similarity, representative = best
+                diff = fingerprints.duplicate_diff(component_files[representative], file_paths, root_dir)
+                duplicates[name] = {'representative': representative, 'similarity': similarity,
+                                    'note': f"Near-duplicate of `{representative}` (about {similarity:.0%} similar), "
+                                            f"see its summary. Differences:\n\n```diff\n{diff}\n```"}
+                continue
+
+        representatives.append((name, file_paths))
+        exact_groups[exact_key] = name
+        if signature is not None:
+            representative_signatures[name] = signature
+            for band in bands:
+                lsh_buckets.setdefault(band, []).append(name)
+
+    fingerprints.save()
+    exact = sum(1 for duplicate in duplicates.values() if duplicate['similarity'] == 1.0)
+    run_stats.record_duplicates(exact, len(duplicates) - exact)
+    logger.info(f"Deduplication found {exact} identical and {len(duplicates) - exact} near-identical components, "
+                f"saving {len(duplicates)} of {len(components)} summaries.")
+    return representatives, duplicates
+
+
+def duplicate_summaries(components: List[Tuple[str, List[str]]], duplicates: Dict[str, Dict[str, Any]],
+                        summaries: Dict[str, Tuple[str, float]]) -> Dict[str, Tuple[str, float]]:
+    """Returns summaries of the duplicates that reference the summary of their representative."""
+    duplicate_summaries = {}
+    for name, file_paths in components:
+        duplicate = duplicates.get(name)
+        if duplicate and duplicate['representative'] in summaries:
+            file_names = ", ".join(os.path.basename(file_path) for file_path in file_paths)
+            duplicate_summaries[name] = (f"## {file_names}\n{duplicate['note']}", DUPLICATE_RELEVANCE)
+    return duplicate_summaries
+
+
+def load_batch_state() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Loads the batches submitted by an earlier run that haven't been loaded into the cache yet."""
+    if os.path.exists(BATCH_STATE_FILE):
+        with open(BATCH_STATE_FILE, "r", encoding="utf-8") as file:
+            return json.load(file)
+    return {}
+
+
+def save_batch_state(state: Dict[str, Dict[str, Dict[str, Any]]]):
+    """Saves the outstanding batches, mapping batch IDs to the requests (custom_id -> file_key and record) in them."""
+    if state:
+        write_file_atomically(BATCH_STATE_FILE, json.dumps(state, ensure_ascii=False, indent=4).encode("utf-8"))
+    elif os.path.exists(BATCH_STATE_FILE):
+        os.remove(BATCH_STATE_FILE)
+
+
+def write_batch_files(requests: List[Dict[str, Any]], batch_dir: str) -> List[Tuple[str, Dict[str, Dict[str, Any]]]]:
+    """Writes the prepared summary requests into batch input files, respecting the request and size limits per batch.
+
+    Returns the path of every file with the requests it contains (custom_id -> file_key and record).
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    batch_files = []
+    lines = []
+    size = 0
+    custom_ids = {}
+
+    def flush():
+        nonlocal lines, size, custom_ids
+        if lines:
+            path = os.path.join(batch_dir, f"batch-{timestamp}-{len(batch_files) + 1}.jsonl")
+            with open(path, "wb") as file:
+                file.writelines(lines)
+            batch_files.append((path, custom_ids))
+        lines, size, custom_ids = [], 0, {}
+
+    for index, request in enumerate(requests):
+        custom_id = f"component-{index}"
+        line = (json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": MODEL, "messages": component_summary_messages(request['prompt'])},
+        }, ensure_ascii=False) + "\n").encode("utf-8")
+        if len(lines) >= BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_BYTES:
+            flush()
+        lines.append(line)
+        size += len(line)
+        custom_ids[custom_id] = {'file_key': request['file_key'], 'record': request['record']}
+    flush()
+    return batch_files
+
+
+def openai_client() -> OpenAI:
+    """Returns the OpenAI client of the backend, for the endpoints beyond chat completions."""
+    current_backend = get_backend()
+    if not isinstance(current_backend, OpenAIBackend):
+        raise ValueError("The Batch API is only available with the OpenAI backend.")
+    return current_backend.client
+
+
+def submit_batch(path: str) -> str:
+    """Uploads a batch input file and creates a batch for it. Returns the batch ID."""
+    logger.info(f"Uploading batch file {path}...")
+    client = openai_client()
+    with open(path, "rb") as file:
+        input_file = client.files.create(file=file, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    logger.info(f"Submitted batch {batch.id}.")
+    return batch.id
+
+
+def wait_for_batch(batch_id: str, poll_interval: float) -> Any:
+    """Polls a batch until it is completed, failed, expired or cancelled."""
+    while True:
+        batch = openai_client().batches.retrieve(batch_id)
+        counts = batch.request_counts
+        progress = f", {counts.completed + counts.failed}/{counts.total} requests done" if counts else ""
+        logger.info(f"Batch {batch_id} is {batch.status}{progress}.")
+        if batch.status in BATCH_FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def download_batch_results(batch: Any) -> Dict[str, str]:
+    """Downloads the output of a finished batch and returns the summary of every successful request by custom_id."""
+    client = openai_client()
+    summaries = {}
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                body = response["body"]
+                summaries[result["custom_id"]] = body["choices"][0]["message"]["content"]
+                usage = body.get("usage") or {}
+                run_stats.record_request(LLMResponse(summaries[result["custom_id"]], usage.get("prompt_tokens", 0),
+                                                     usage.get("completion_tokens", 0)),
+                                         MODEL, result["custom_id"], batch=True)
+    if batch.error_file_id:
+        error_count = sum(1 for line in client.files.content(batch.error_file_id).text.splitlines() if line.strip())
+        logger.warning(f"{error_count} requests of batch {batch.id} failed, they will be summarized directly.")
+    return summaries
+
+
+def collect_batch(batch_id: str, custom_ids: Dict[str, Dict[str, Any]], results: ResultsStore, poll_interval: float) -> int:
+    """Waits for a batch and stores its summaries in the intermediate results. Returns the number of summaries stored."""
+    batch = wait_for_batch(batch_id, poll_interval)
+    summaries = download_batch_results(batch)
+    for custom_id, summary in summaries.items():
+        if custom_id in custom_ids:
+            store_component_summary(results, custom_ids[custom_id], summary)
+    logger.info(f"Loaded {len(summaries)} of {len(custom_ids)} summaries from batch {batch_id} ({batch.status}).")
+    return len(summaries)
+
+
+def summarize_components_in_batches(components: List[Tuple[str, List[str]]], results: ResultsStore,
+                                    project_context: ProjectContext, max_prompt_tokens: int = MAX_PROMPT_TOKENS,
+                                    batch_dir: str = BATCH_DIR, poll_interval: float = BATCH_POLL_INTERVAL):
+    """Summarizes the components that aren't cached through the Batch API and loads the summaries into the cache.
+
+    Batches submitted by an interrupted earlier run are collected first instead of being submitted again.
+    Components too large for a single request and failed requests are left to `summarize_components`.
+    """
+    state = load_batch_state()
+    for batch_id, custom_ids in list(state.items()):
+        logger.info(f"Collecting batch {batch_id} from an earlier run...")
+        collect_batch(batch_id, custom_ids, results, poll_interval)
+        del state[batch_id]
+        save_batch_state(state)
+
+    pending = []
+    for name, file_paths in components:
+        existing_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
+        if existing_paths:
+            _, request = prepare_component_summary(existing_paths, results, project_context, max_prompt_tokens)
+            if request and not request['oversized']:
+                pending.append(request)
+    if not pending:
+        logger.info("No pending summaries for the Batch API.")
+        return
+
+    logger.info(f"Submitting {len(pending)} summaries to the Batch API...")
+    for path, custom_ids in write_batch_files(pending, batch_dir):
+        state[submit_batch(path)] = custom_ids
+        save_batch_state(state)
+
+    for batch_id, custom_ids in list(state.items()):
+        collect_batch(batch_id, custom_ids, results, poll_interval)
+        del state[batch_id]
+        save_batch_state(state)
+
+
+def rank_by_relevance(summaries: Dict[str, Tuple[str, float]]) -> List[Tuple[str, Tuple[str, float]]]:
+    """Sorts the summaries by relevance, most relevant first, and ties by component name.
+
+    The order picks the components of the title/overview prompt and orders the README, so it must not depend on
+    the order in which the components were discovered.
+    """
+    return sorted(summaries.items(), key=lambda item: (-item[1][1], item[0]))
+
+
 def generate_project_overview_and_file_tree(summaries: Dict[str, Tuple[str, float]],
                                             project_structure: Dict[str, List[str]]) -> Tuple[str, str]:
     """Generates a project overview and file tree using the 5 most relevant components."""
-    print("Generating project overview and file tree...")
-    sorted_summaries = sorted(summaries.items(), key=lambda item: item[1][1], reverse=True)[:5]
+    logger.debug("Generating project overview and file tree...")
+    sorted_summaries = rank_by_relevance(summaries)[:5]
 
     project_overview_content = "This project consists of several components, with the following being the most crucial:\n"
     for name, (summary, relevance) in sorted_summaries:
@@ -273,13 +2446,13 @@ def generate_project_overview_and_file_tree(summaries: Dict[str, Tuple[str, floa
         [f"{key}:\n  " + "\n  ".join(files) for key, files in project_structure.items()]
     )
 
-    print("Project overview and file tree generated.")
+    logger.debug("Project overview and file tree generated.")
     return project_overview_content, structure_description
 
 
 def extract_title_overview_and_tree(content: str) -> Tuple[str, str, str]:
     """Extracts the title, project overview, and file tree from the generated content."""
-    print("Extracting title, project overview, and file tree...")
+    logger.debug("Extracting title, project overview, and file tree...")
     title_marker = "Project Title:"
     overview_marker = "Project Overview:"
     file_tree_marker = "File Tree Graph:"
@@ -288,7 +2461,7 @@ def extract_title_overview_and_tree(content: str) -> Tuple[str, str, str]:
     overview = extract_section(content, overview_marker)
     file_tree = extract_section(content, file_tree_marker)
 
-    print(f"Extracted title: {title}, overview: {overview[:30]}..., file tree: {file_tree[:30]}...")
+    logger.debug(f"Extracted title: {title}, overview: {overview[:30]}..., file tree: {file_tree[:30]}...")
     return title, overview, file_tree
 
 
@@ -307,13 +2480,148 @@ def extract_section(content: str, marker: str) -> str:
     return section
 
 
-def generate_title_and_overview_with_tree(sorted_summaries: List[Tuple[str, Tuple[str, float]]], file_tree: str) -> Tuple[str, str, str]:
-    """Generates the title, project overview, and file tree using GPT based on the 5 most relevant components."""
-    print("Generating title, project overview, and file tree with GPT...")
-    components_overview = "\n".join(
-        [f"{os.path.basename(name)}: {summary.splitlines()[1]}" for name, (summary, _) in sorted_summaries])
+def create_directory_rollup_prompt(directory: str, contents: str) -> str:
+    """Creates the prompt that summarizes a directory from the summaries of its components and subdirectories."""
+    return (
+        f"Summarize the directory `{directory}/` of a software project in one paragraph of at most "
+        f"{ROLLUP_SUMMARY_WORDS} words, based on the following summaries of the components and subdirectories it "
+        f"contains. Describe its purpose, its main parts and how they work together. Don't use any markup.\n\n"
+        f"Contents:\n{contents}"
+    )
 
-    prompt = (
+
+def format_rollup_entries(entries: List[Tuple[str, str, float]], max_tokens: int) -> str:
+    """Lists (name, summary, relevance) entries, most relevant first, within a budget of `max_tokens` tokens.
+
+    Each summary is cut to ROLLUP_ITEM_TOKENS. Entries that don't fit are only named at the end.
+    """
+    lines = []
+    omitted = []
+    used_tokens = 0
+    reserved_tokens = min(ROLLUP_ITEM_TOKENS, max_tokens // 2)  # for the names of the omitted entries
+    budget = max_tokens - reserved_tokens
+    for name, summary, _ in sorted(entries, key=lambda entry: (-entry[2], entry[0])):
+        line = f"- {name}: {truncate_to_tokens(' '.join(summary.split()), ROLLUP_ITEM_TOKENS)}"
+        line_tokens = estimate_tokens(line)
+        if used_tokens + line_tokens > budget:
+            omitted.append(name)
+            continue
+        lines.append(line)
+        used_tokens += line_tokens
+    if omitted:
+        lines.append(f"- Also contains: {truncate_to_tokens(', '.join(omitted), reserved_tokens)}")
+    return "\n".join(lines)
+
+
+def component_overview_text(summary: str) -> str:
+    """Returns the overview section of a component summary, or the whole summary without its heading."""
+    overview = re.search(r"###\s*Overview\s*\n(.*?)(?=\n#|\Z)", summary, re.DOTALL)
+    if overview:
+        return overview.group(1).strip()
+    return "\n".join(remove_relevance_score(summary).splitlines()[1:]).strip()
+
+
+@timed("directory_rollups")
+def generate_directory_rollups(summaries: Dict[str, Tuple[str, float]], results: ResultsStore, max_workers: int,
+                               max_tokens: int = ROLLUP_INPUT_TOKENS, overview_tokens: Optional[int] = None) -> str:
+    """Summarizes the directories of the components bottom-up and returns the overview of the top level.
+
+    Each rollup prompt is built from the summaries of the components in the directory and the rollups of its
+    subdirectories, within `max_tokens`. The returned overview is limited to `overview_tokens` (by default
+    `max_tokens`), so it can share the budget of the final prompt. Directories of one depth are summarized
+    concurrently. Rollups are cached under a hash of their prompt, so a changed component only invalidates the
+    rollups on its path to the root.
+    Directories with a single component or subdirectory reuse its summary instead.
+    """
+    components_in = {"": []}
+    children = {"": set()}
+    for name in summaries:
+        directory = os.path.dirname(name)
+        components_in.setdefault(directory, []).append(name)
+        while directory:
+            parent = os.path.dirname(directory)
+            components_in.setdefault(parent, [])
+            children.setdefault(parent, set()).add(directory)
+            children.setdefault(directory, set())
+            directory = parent
+
+    # The top level is the first directory that doesn't just hold a single subdirectory
+    top = ""
+    while not components_in[top] and len(children[top]) == 1:
+        top = next(iter(children[top]))
+
+    rollups = {}  # directory -> (rollup, highest relevance below it)
+    outcomes = Counter()
+
+    def entries_of(directory: str) -> List[Tuple[str, str, float]]:
+        entries = [(os.path.basename(name), component_overview_text(summaries[name][0]), summaries[name][1])
+                   for name in components_in[directory]]
+        entries += [(os.path.basename(child) + "/",) + rollups[child] for child in children[directory]]
+        return entries
+
+    def rollup(directory: str):
+        entries = entries_of(directory)
+        if len(entries) == 1:
+            rollups[directory] = entries[0][1:]
+            outcomes["passed through"] += 1
+            return
+        entry_tokens = max_tokens - estimate_tokens(create_directory_rollup_prompt(directory, ""))
+        prompt = create_directory_rollup_prompt(directory, format_rollup_entries(entries, entry_tokens))
+        cache_key = hash_text("\n".join([MODEL, str(ROLLUP_PROMPT_VERSION), prompt]))
+        key = ROLLUP_KEY_PREFIX + directory
+        cached_data = results.get(key)
+        if cached_data and cached_data.get('cache_key') == cache_key:
+            summary = cached_data['summary']
+            outcomes["reused"] += 1
+        else:
+            summary = create_chat_completion([
+                {"role": "system", "content": "You are an AI assistant specialized in summarizing the architecture of "
+                                              "software projects."},
+                {"role": "user", "content": prompt},
+            ], key).content.strip()
+            results[key] = {'cache_key': cache_key, 'summary': summary}
+            outcomes["generated"] += 1
+        rollups[directory] = (summary, max(relevance for _, _, relevance in entries))
+
+    # Everything below the top level, deepest first; the directories of one depth don't depend on each other
+    below_top = [directory for directory in children if directory.startswith(top + "/" if top else "")
+                 and directory not in ("", top)]
+    depths = sorted({directory.count("/") for directory in below_top}, reverse=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for depth in depths:
+            list(executor.map(rollup, sorted(directory for directory in below_top if directory.count("/") == depth)))
+
+    logger.info(f"Directory rollups below {top + '/' if top else 'the project root'}: {outcomes['generated']} generated, "
+                f"{outcomes['reused']} reused, {outcomes['passed through']} passed through.")
+    return format_rollup_entries(entries_of(top), max_tokens if overview_tokens is None else overview_tokens)
+
+
+def directory_outline(project_structure: Dict[str, List[str]], root_dir: str, max_tokens: int = ROLLUP_INPUT_TOKENS) -> str:
+    """Describes the directory tree with the number of files below each directory, as deep as fits into `max_tokens`."""
+    file_counts = Counter()
+    for folder, files in project_structure.items():
+        directory = relative_to_root(folder, root_dir)
+        directory = "" if directory == "." else directory
+        file_counts[""] += len(files)
+        while directory:
+            file_counts[directory] += len(files)
+            directory = os.path.dirname(directory)
+
+    outline = ""
+    for max_depth in range(max((directory.count("/") + 1 for directory in file_counts), default=0), -1, -1):
+        lines = [f"./ ({file_counts['']} files)"] + [
+            f"{'  ' * (directory.count('/') + 1)}{os.path.basename(directory)}/ ({count} files)"
+            for directory, count in sorted(file_counts.items()) if directory and directory.count("/") < max_depth
+        ]
+        outline = "\n".join(lines)
+        if estimate_tokens(outline) <= max_tokens:
+            break
+    return truncate_to_tokens(outline, max_tokens)
+
+
+def create_title_prompt(components_overview: str, file_tree: str) -> str:
+    """Creates the prompt that generates the project title, overview and file tree graph."""
+    return (
         f"Based on the following components and file tree, generate a project title, overview"
         f" and a file tree graph diagram with the root having the project name: \n\n"
         f"Components Overview: \n{components_overview}\n\n"
@@ -324,22 +2632,43 @@ def generate_title_and_overview_with_tree(sorted_summaries: List[Tuple[str, Tupl
         f"surrounded by triple backticks."
     )
 
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an AI assistant specialized in generating project titles, overviews, and file tree graphs."
-            },
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ]
-    )
 
-    title, overview, file_tree = extract_title_overview_and_tree(completion.choices[0].message.content)
-    print(f"Generated title: {title}, overview length: {len(overview)}, file tree length: {len(file_tree)}")
+def generate_title_and_overview_with_tree(sorted_summaries: List[Tuple[str, Tuple[str, float]]], file_tree: str,
+                                          results: Optional[ResultsStore] = None,
+                                          components_overview: Optional[str] = None) -> Tuple[str, str, str]:
+    """Generates the title, project overview, and file tree using GPT based on the 5 most relevant components.
+
+    `components_overview` replaces the overview of the components, e.g. with the top-level directory rollups.
+    If `results` is given, the answer is cached there under a hash of the prompt (built from the components
+    and the file tree), the model and the prompt version, and reused as long as that doesn't change.
+    """
+    if components_overview is None:
+        components_overview = "\n".join(
+            [f"{os.path.basename(name)}: {summary.splitlines()[1]}" for name, (summary, _) in sorted_summaries])
+
+    prompt = create_title_prompt(components_overview, file_tree)
+    cache_key = hash_text("\n".join([MODEL, str(TITLE_PROMPT_VERSION), prompt]))
+    cached_data = results.get(TITLE_OVERVIEW_KEY) if results is not None else None
+    if cached_data and cached_data.get('cache_key') == cache_key:
+        logger.info("Title, project overview, and file tree are up to date. Skipping...")
+        return cached_data['title'], cached_data['overview'], cached_data['file_tree']
+
+    logger.debug("Generating title, project overview, and file tree with GPT...")
+    completion = create_chat_completion([
+        {
+            "role": "system",
+            "content": "You are an AI assistant specialized in generating project titles, overviews, and file tree graphs."
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ], TITLE_OVERVIEW_KEY)
+
+    title, overview, file_tree = extract_title_overview_and_tree(completion.content)
+    logger.debug(f"Generated title: {title}, overview length: {len(overview)}, file tree length: {len(file_tree)}")
+    if results is not None:
+        results[TITLE_OVERVIEW_KEY] = {'cache_key': cache_key, 'title': title, 'overview': overview, 'file_tree': file_tree}
     return title, overview, file_tree
 
 
@@ -350,21 +2679,109 @@ def strip_markdown(text: str) -> str:
     return text.strip()
 
 
-def generate_readme(title: str, project_overview: str, file_tree: str, summaries: Dict[str, Tuple[str, float]]) -> str:
-    """Generates the final README by combining the title, project overview, file tree, and all component summaries."""
-    print("Generating final README...")
+README_SECTION_START = "<!-- autodoc:component {} -->"
+README_SECTION_END = "<!-- autodoc:end -->"
+README_SECTION_PATTERN = re.compile(r"<!-- autodoc:component (.+?) -->\n(.*?)\n<!-- autodoc:end -->", re.DOTALL)
+
+
+def render_readme_section(name: str, summary: str, stale: bool = False) -> str:
+    """Renders the README section of one component, wrapped in markers so it can be replaced in place later.
+
+    Outdated summaries get a note below their heading.
+    """
+    content = remove_relevance_score(summary)
+    if stale:
+        heading, _, body = content.partition("\n")
+        content = f"{heading}\n{STALE_SECTION_NOTE}\n{body}"
+    return f"{README_SECTION_START.format(name)}\n{content}\n{README_SECTION_END}"
+
+
+@timed("generate_readme")
+def generate_readme(title: str, project_overview: str, file_tree: str, summaries: Dict[str, Tuple[str, float]],
+                    stale: Optional[set] = None) -> str:
+    """Generates the final README by combining the title, project overview, file tree, and all component summaries.
+
+    The sections of the components in `stale` are marked as outdated.
+    """
+    stale = stale or set()
+    logger.debug("Generating final README...")
     clean_title = strip_markdown(title)
-    sorted_summaries = sorted(summaries.items(), key=lambda item: item[1][1], reverse=True)
+    sorted_summaries = rank_by_relevance(summaries)
 
     # Apply `remove_relevance_score` to each summary to properly format it
-    summary_content_list = [remove_relevance_score(summary) for _, (summary, _) in sorted_summaries]
+    summary_content_list = [render_readme_section(name, summary, name in stale) for name, (summary, _) in sorted_summaries]
     summary_content = "\n\n".join(summary_content_list)
 
     readme_content = f"# {clean_title}\n\n## Project Overview\n\n{project_overview}\n\n## File Tree\n\n{file_tree}\n\n## Component Summaries\n\n{summary_content}"
-    print("README content generated.")
+    logger.debug("README content generated.")
     return readme_content
 
 
+def patch_readme(readme_content: str, summaries: Dict[str, Tuple[str, float]], changed_names: List[str],
+                 stale: Optional[set] = None) -> Optional[str]:
+    """Replaces the sections of the changed components in an existing README. Returns None if one is missing."""
+    stale = stale or set()
+    changed = set(changed_names)
+    found = set()
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name not in changed:
+            return match.group(0)
+        found.add(name)
+        return render_readme_section(name, summaries[name][0], name in stale)
+
+    patched = README_SECTION_PATTERN.sub(replace, readme_content)
+    return patched if found == changed else None
+
+
+def write_readme(readme_path: str, title: str, project_overview: str, file_tree: str,
+                 summaries: Dict[str, Tuple[str, float]], results: ResultsStore, stale: Optional[set] = None) -> bool:
+    """Writes the README, unless neither its inputs nor the file on disk changed since it was last written.
+
+    If only some component summaries changed (same title, overview, file tree and order of the components) and
+    the README wasn't edited since, just the sections of those components are replaced. The sections of the
+    components in `stale` are marked as outdated. Returns whether the README was written.
+    """
+    stale = stale or set()
+    inputs_hash = hash_text(json.dumps([title, project_overview, file_tree, sorted(summaries.items()), sorted(stale)],
+                                       ensure_ascii=False))
+    header_hash = hash_text(json.dumps([title, project_overview, file_tree], ensure_ascii=False))
+    order = [name for name, _ in rank_by_relevance(summaries)]
+    section_hashes = {name: hash_text(render_readme_section(name, summary, name in stale))
+                      for name, (summary, _) in summaries.items()}
+
+    cached_data = results.get(README_KEY)
+    is_unedited = (cached_data is not None and cached_data.get('path') == readme_path and os.path.exists(readme_path)
+                   and list(file_stat_signature(readme_path)) == cached_data.get('stat'))
+    if is_unedited and cached_data.get('inputs_hash') == inputs_hash:
+        logger.info(f"README.md at {readme_path} is up to date. Skipping...")
+        return False
+
+    readme_content = None
+    if is_unedited and cached_data.get('header_hash') == header_hash and cached_data.get('order') == order:
+        cached_sections = cached_data.get('sections', {})
+        changed_names = [name for name in order if cached_sections.get(name) != section_hashes[name]]
+        with open(readme_path, "r", encoding="utf-8") as readme_file:
+            readme_content = patch_readme(readme_file.read(), summaries, changed_names, stale)
+        if readme_content is not None:
+            logger.info(f"Updating {len(changed_names)} sections of README.md...")
+    if readme_content is None:
+        readme_content = generate_readme(title, project_overview, file_tree, summaries, stale)
+
+    write_file_atomically(readme_path, readme_content.encode("utf-8"))
+    results[README_KEY] = {
+        'inputs_hash': inputs_hash,
+        'header_hash': header_hash,
+        'order': order,
+        'sections': section_hashes,
+        'path': readme_path,
+        'stat': list(file_stat_signature(readme_path)),
+    }
+    logger.info(f"README.md has been generated at {readme_path}")
+    return True
+
+
 def remove_relevance_score(summary: str) -> str:
     """Remove the relevance score from the summary."""
     summary_lines = summary.splitlines()
@@ -375,56 +2792,611 @@ def remove_relevance_score(summary: str) -> str:
     return "\n".join(filtered_lines).strip()
 
 
-def main():
-    if len(sys.argv) < 3:
-        print("Usage: python generate_readme.py <root_dir> <folder1> <folder2> ... <folderN>")
-        sys.exit(1)
-
-    root_dir = sys.argv[1]
-    folders_to_analyze = sys.argv[2:]
-    file_types = [".h", ".cpp", ".glsl", "CMakeLists.txt"]
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parses a shard given as I/N."""
+    match = re.fullmatch(r"(\d+)/(\d+)", value.strip())
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"expected I/N with 1 <= I <= N, got '{value}'")
+    return int(match.group(1)), int(match.group(2))
 
-    print("Loading intermediate results...")
-    results = load_intermediate_results()
 
-    print("Listing project files...")
-    project_structure = list_files(root_dir, file_types, folders_to_analyze, file_types)
-    project_overview = "\n".join([f"{subdir}:\n  " + "\n  ".join(files) for subdir, files in project_structure.items()])
-
-    summaries = {}
-    for subdir, files in project_structure.items():
-        paired_files = pair_header_and_source_files(files)
-
-        for name, file_paths in paired_files.items():
-            if name != "unpaired_files" and file_paths:
-                file_contents = [read_file(file_path) for file_path in file_paths if os.path.exists(file_path)]
-                if file_contents:
-                    summary, relevance = summarize_component_files(file_paths, file_contents, results, project_overview)
-                    summaries[name] = (summary, relevance)
-                else:
-                    print(f"Warning: No content found for files {file_paths}. Skipping...")
-
-        for file_path in paired_files.get("unpaired_files", []):
-            file_content = read_file(file_path)
-            summary, relevance = summarize_component_files([file_path], [file_content], results, project_overview)
-            summaries[os.path.basename(file_path)] = (summary, relevance)
-
-    print("Generating project overview and file tree...")
+def parse_args(argv: List[str], command: str = "run") -> argparse.Namespace:
+    """Parses the command line arguments of a regular run, or of the given subcommand."""
+    descriptions = {
+        "run": "Generates a README.md for a project by summarizing its source files with OpenAI.",
+        "watch": "Generates a README.md and keeps it up to date while the source files change.",
+        "merge": "Merges the intermediate results of the shards of a run and generates the README.md.",
+    }
+    parser = argparse.ArgumentParser(prog="main.py" if command == "run" else f"main.py {command}",
+                                     description=descriptions[command])
+    parser.add_argument("root_dir", help="root directory of the project (scanned non-recursively)")
+    parser.add_argument("folders", nargs="+", help="folders to scan recursively")
+    parser.add_argument("--model", default=MODEL, help="model used for all requests")
+    parser.add_argument("--backend", choices=BACKENDS, default="openai",
+                        help="'fake' answers with deterministic summaries without any network requests")
+    parser.add_argument("--fake-latency", type=float, default=FAKE_LATENCY,
+                        help="seconds each request of the fake backend takes")
+    parser.add_argument("--fake-completion-tokens", type=int, default=FAKE_COMPLETION_TOKENS,
+                        help="approximate length of the answers of the fake backend")
+    parser.add_argument("--record", metavar="PATH", help="record all responses of the backend to this file")
+    parser.add_argument("--replay", metavar="PATH", help="answer requests with the responses recorded in this file")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="skip files and folders matching this .gitignore-style pattern (repeatable)")
+    parser.add_argument("--no-gitignore", action="store_true",
+                        help="don't apply the patterns of the .gitignore in the root directory")
+    parser.add_argument("--pair-rule", action="append", default=[], metavar="HEADERS:SOURCES",
+                        help="also pair headers and sources in these folders, e.g. 'api:impl' (repeatable)")
+    parser.add_argument("--no-unique-stem-pairing", action="store_true",
+                        help="don't pair a header and a source in unrelated folders just because their names match")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help="maximum number of requests in flight at the same time (1 = sequential)")
+    parser.add_argument("--requests-per-minute", type=float, default=REQUESTS_PER_MINUTE,
+                        help="request rate limit of the account (0 = unlimited)")
+    parser.add_argument("--tokens-per-minute", type=float, default=TOKENS_PER_MINUTE,
+                        help="token rate limit of the account (0 = unlimited)")
+    parser.add_argument("--max-prompt-tokens", type=int, default=MAX_PROMPT_TOKENS,
+                        help="components with larger prompts are summarized in chunks and merged")
+    parser.add_argument("--context-mode", choices=CONTEXT_MODES, default=DEFAULT_CONTEXT_MODE,
+                        help="how much of the project structure to include in each component prompt")
+    parser.add_argument("--batch", action="store_true",
+                        help="summarize uncached components with the Batch API (cheaper, but can take up to 24h)")
+    parser.add_argument("--batch-dir", default=BATCH_DIR, help="folder for the batch input files")
+    parser.add_argument("--batch-poll-interval", type=float, default=BATCH_POLL_INTERVAL,
+                        help="seconds between two status checks of a batch")
+    parser.add_argument("--results-backend", choices=sorted(RESULTS_STORES), default=DEFAULT_RESULTS_BACKEND,
+                        help="format of the intermediate results cache")
+    parser.add_argument("--results-file", help="path of the intermediate results cache "
+                                               "(defaults to intermediate_results.<backend>)")
+    parser.add_argument("--compact-results", action="store_true",
+                        help="compact the intermediate results cache at the end of the run")
+    parser.add_argument("--no-preprocess", action="store_true",
+                        help="send the files as they are instead of removing license banners and cutting long bodies")
+    parser.add_argument("--max-body-tokens", type=int, default=MAX_BODY_TOKENS,
+                        help="function bodies and initializers longer than this are cut (0 keeps them whole)")
+    parser.add_argument("--overview-mode", choices=OVERVIEW_MODES, default=DEFAULT_OVERVIEW_MODE,
+                        help="'rollup' builds the project overview from directory summaries, for large projects")
+    parser.add_argument("--rollup-tokens", type=int, default=ROLLUP_INPUT_TOKENS,
+                        help="token budget of each directory rollup prompt and of the final prompt in rollup mode")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="summarize identical and near-identical components separately")
+    parser.add_argument("--near-duplicate-threshold", type=float, default=NEAR_DUPLICATE_THRESHOLD,
+                        help="estimated similarity above which components are treated as near-duplicates")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=DEFAULT_LOG_LEVEL,
+                        help="DEBUG also logs every file, cache lookup and request")
+    parser.add_argument("--report", metavar="PATH",
+                        help="write a JSON report with timings, token usage, costs and cache hits of the run")
+    parser.add_argument("--prometheus-textfile", metavar="PATH",
+                        help="write the metrics of the run in the Prometheus text format")
+    parser.add_argument("--profile", nargs="?", const=PROFILE_FILE, metavar="PATH",
+                        help=f"profile the run and its worker threads with cProfile and save the statistics "
+                             f"(default {PROFILE_FILE})")
+    if command == "run":
+        parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                            help="only summarize the I-th of N parts of the components (1-based), for spreading a run "
+                                 "over several machines; the README is generated by `main.py merge`")
+    if command in ("run", "merge"):
+        parser.add_argument("--max-seconds", type=float, metavar="SECONDS",
+                            help="stop requesting component summaries after this many seconds; components left over "
+                                 "keep their previous summary, marked as outdated in the README")
+        parser.add_argument("--max-tokens", type=int, metavar="TOKENS",
+                            help="stop requesting component summaries before the run uses more tokens than this")
+    if command == "merge":
+        parser.add_argument("--shard-results", nargs="+", required=True, metavar="PATH",
+                            help="intermediate results files of the shards to merge into --results-file")
+    if command == "watch":
+        parser.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE,
+                            help="seconds without further changes before the documentation is updated")
+        parser.add_argument("--polling", action="store_true", help="poll for changes even if inotify is available")
+        parser.add_argument("--poll-interval", type=float, default=WATCH_POLL_INTERVAL,
+                            help="seconds between two scans when polling for changes")
+    args = parser.parse_args(argv)
+    args.shard = getattr(args, "shard", None)
+    args.max_seconds = getattr(args, "max_seconds", None)
+    args.max_tokens = getattr(args, "max_tokens", None)
+    if args.shard and not args.results_file:
+        args.results_file = shard_results_file(args.results_backend, args.shard)
+    if command == "merge":
+        missing = [path for path in args.shard_results if not os.path.exists(path)]
+        if missing:
+            parser.error(f"shard results not found: {', '.join(missing)}")
+    if command == "watch" and args.batch:
+        parser.error("--batch can't be used in watch mode")
+    for rule in args.pair_rule:
+        try:
+            parse_pairing_rule(rule)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be combined")
+    if args.batch and (args.backend != "openai" or args.record or args.replay):
+        parser.error("--batch is only available with the OpenAI backend")
+    if args.max_concurrency < 1:
+        parser.error("--max-concurrency must be at least 1")
+    if not 0 < args.near_duplicate_threshold <= 1:
+        parser.error("--near-duplicate-threshold must be greater than 0 and at most 1")
+    if args.max_prompt_tokens < MIN_CHUNK_TOKENS:
+        parser.error(f"--max-prompt-tokens must be at least {MIN_CHUNK_TOKENS}")
+    if args.max_body_tokens < 0:
+        parser.error("--max-body-tokens can't be negative")
+    if args.rollup_tokens < 2 * ROLLUP_ITEM_TOKENS:
+        parser.error(f"--rollup-tokens must be at least {2 * ROLLUP_ITEM_TOKENS}")
+    if (args.max_seconds is not None and args.max_seconds <= 0) or (args.max_tokens is not None and args.max_tokens <= 0):
+        parser.error("--max-seconds and --max-tokens must be positive")
+    return args
+
+
+def create_backend(args: argparse.Namespace) -> LLMBackend:
+    """Creates the backend selected on the command line, wrapped for recording or replaying if requested."""
+    if args.replay:
+        return RecordReplayBackend(args.replay)
+    selected = FakeBackend(args.fake_latency, args.fake_completion_tokens) if args.backend == "fake" else OpenAIBackend()
+    return RecordReplayBackend(args.record, selected) if args.record else selected
+
+
+def discover_project(args: argparse.Namespace) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    """Lists the project files and builds the component index."""
+    logger.info("Listing project files...")
+    ignore_rules = load_ignore_rules(args.root_dir, args.exclude, not args.no_gitignore)
+    project_structure = list_files(args.root_dir, FILE_TYPES, args.folders, FILE_TYPES, ignore_rules)
+    component_index = build_component_index(project_structure, args.root_dir, DEFAULT_PAIRING_RULES + args.pair_rule,
+                                            not args.no_unique_stem_pairing)
+    return project_structure, component_index
+
+
+def update_readme(args: argparse.Namespace, results: ResultsStore, project_structure: Dict[str, List[str]],
+                  summaries: Dict[str, Tuple[str, float]], stale: Optional[set] = None) -> bool:
+    """Generates (or reuses) the title, overview and file tree graph and writes the README if anything changed.
+
+    The sections of the components in `stale` are marked as outdated.
+    """
+    logger.info("Generating project overview and file tree...")
     project_overview_content, file_tree = generate_project_overview_and_file_tree(summaries, project_structure)
-
-    print("Generating title, project overview, and file tree graph with GPT...")
+    components_overview = None
+    if args.overview_mode == "rollup":
+        # The outline and the top-level rollups share the budget of the final prompt, the outline taking at most half
+        budget = args.rollup_tokens - estimate_tokens(create_title_prompt("", ""))
+        file_tree = directory_outline(project_structure, args.root_dir, budget // 2)
+        logger.info("Summarizing directories bottom-up...")
+        components_overview = generate_directory_rollups(summaries, results, args.max_concurrency, args.rollup_tokens,
+                                                         budget - estimate_tokens(file_tree))
+
+    logger.info("Generating title, project overview, and file tree graph with GPT...")
     title, project_overview, file_tree_graph = generate_title_and_overview_with_tree(
-        sorted(summaries.items(), key=lambda item: item[1][1], reverse=True)[:5], file_tree
+        rank_by_relevance(summaries)[:5], file_tree, results,
+        components_overview
     )
 
-    print("Generating the final README...")
-    readme_content = generate_readme(title, project_overview, file_tree_graph, summaries)
-    readme_path = os.path.join(root_dir, "README.md")
+    logger.info("Generating the final README...")
+    return write_readme(os.path.join(args.root_dir, "README.md"), title, project_overview, file_tree_graph,
+                        summaries, results, stale)
+
+
+def report_run(args: argparse.Namespace, stats: RunStats) -> Dict[str, Any]:
+    """Logs the statistics of the run and writes the report files requested on the command line."""
+    stats_dict = stats.as_dict()
+    log_run_summary(stats_dict)
+    if args.report:
+        write_run_report(stats_dict, args.report)
+    if args.prometheus_textfile:
+        write_prometheus_textfile(stats_dict, args.prometheus_textfile)
+    return stats_dict
+
+
+def shard_of(name: str, shard_count: int) -> int:
+    """Assigns a component to one of `shard_count` shards (1-based) by a hash of its name, the same on every machine."""
+    return int(hash_text(name)[:16], 16) % shard_count + 1
+
+
+def current_content_hashes(components: List[Tuple[str, List[str]]], stores: List[ResultsStore]) -> set:
+    """Returns the content hashes of the components as they are on disk now.
+
+    Like `is_unchanged_by_stat`, files whose size and modification time match a component record or a dedup
+    fingerprint in one of the `stores` aren't read, the hash stored with them is used instead.
+    """
+    hashes = set()
+    for _, file_paths in components:
+        file_paths = sorted(file_path for file_path in file_paths if os.path.exists(file_path))
+        if not file_paths:
+            continue
+        known_hashes = {}  # (path, size, mtime_ns) -> sha256
+        for store in stores:
+            record = store.get('|'.join(file_paths)) or {}
+            for f in record.get('files', []):
+                known_hashes[(f['path'], f['size'], f['mtime_ns'])] = f['sha256']
+            for fp in file_paths:
+                fingerprint = store.get(FINGERPRINT_KEY_PREFIX + fp)
+                if fingerprint and fingerprint.get('version') == DEDUP_FINGERPRINT_VERSION:
+                    known_hashes[(fp, fingerprint['size'], fingerprint['mtime_ns'])] = fingerprint['sha256']
+        file_hashes = [known_hashes.get((fp, *file_stat_signature(fp))) or hash_text(read_file(fp)) for fp in file_paths]
+        hashes.add(component_content_hash([os.path.basename(fp) for fp in file_paths], file_hashes))
+    return hashes
+
+
+def find_duplicates(args: argparse.Namespace, components: List[Tuple[str, List[str]]],
+                    fingerprints: Optional[FileFingerprints] = None) -> Tuple[List[Tuple[str, List[str]]], Dict[str, Dict[str, Any]]]:
+    """Deduplicates the components unless disabled on the command line. Returns the representatives and duplicates."""
+    if args.no_dedup:
+        return components, {}
+    return deduplicate_components(components, args.root_dir, fingerprints, args.near_duplicate_threshold,
+                                  args.max_concurrency)
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Runs the whole pipeline for the parsed command line arguments and returns the statistics of the run."""
+    configure_backend(create_backend(args), args.model)
+    configure_rate_limiter(args.max_concurrency, args.requests_per_minute, args.tokens_per_minute)
+    configure_preprocessing(not args.no_preprocess, args.max_body_tokens)
+    stats = reset_run_stats()
+
+    logger.info("Loading intermediate results...")
+    results = load_intermediate_results(args.results_backend, args.results_file)
+
+    try:
+        project_structure, component_index = discover_project(args)
+        project_context = ProjectContext(project_structure, args.root_dir, args.context_mode)
+        components = list(component_index.items())
+        representatives, duplicates = find_duplicates(args, components, FileFingerprints(results))
+        if args.shard:
+            index, count = args.shard
+            representatives = [(name, files) for name, files in representatives if shard_of(name, count) == index]
+            logger.info(f"Shard {index}/{count}: summarizing {len(representatives)} components into "
+                        f"{results.path}.")
+
+        if args.batch:
+            summarize_components_in_batches(representatives, results, project_context, args.max_prompt_tokens,
+                                            args.batch_dir, args.batch_poll_interval)
+        budget = None
+        if args.max_seconds or args.max_tokens:
+            budget = Budget(args.max_seconds, args.max_tokens)
+        summaries, stale = summarize_components(representatives, results, project_context, args.max_concurrency,
+                                                args.max_prompt_tokens, budget)
+        summaries.update(duplicate_summaries(components, duplicates, summaries))
+        project_context.report()
+        if args.shard:
+            logger.info("Skipping the README of a shard. Combine the results of all shards with `main.py merge`.")
+        else:
+            update_readme(args, results, project_structure, summaries, stale)
+    finally:
+        close_intermediate_results(results, args.compact_results)
+    return report_run(args, stats)
+
+
+def merge(args: argparse.Namespace) -> Dict[str, Any]:
+    """Merges the intermediate results of the shards of a run into the results file and generates the README.
+
+    Components missing from every shard (e.g. because a shard failed) are summarized during the merge.
+    """
+    configure_backend(create_backend(args), args.model)
+    configure_preprocessing(not args.no_preprocess, args.max_body_tokens)
+
+    results = load_intermediate_results(args.results_backend, args.results_file)
+    try:
+        _, component_index = discover_project(args)
+        merge_intermediate_results(args.shard_results, results, list(component_index.items()))
+    finally:
+        close_intermediate_results(results)
+    return run(args)
+
+
+class FileWatcher:
+    """Reports changed files below the watched folders."""
+
+    def wait_for_changes(self, timeout: Optional[float]) -> Optional[set]:
+        """Waits up to `timeout` seconds (forever if None) for changes.
+
+        Returns the changed paths (empty on timeout), or None if changes were lost and the project has to be rescanned.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(FileWatcher):
+    """Detects changes by comparing the size and modification time of all project files every `interval` seconds."""
+
+    def __init__(self, args: argparse.Namespace, interval: float = WATCH_POLL_INTERVAL):
+        self.args = args
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self) -> Dict[str, Tuple[int, int]]:
+        ignore_rules = load_ignore_rules(self.args.root_dir, self.args.exclude, not self.args.no_gitignore)
+        matcher = FileTypeMatcher(FILE_TYPES)
+        project_structure = {}
+        scan_directory(self.args.root_dir, matcher, False, self.args.root_dir, ignore_rules, project_structure)
+        for folder in self.args.folders:
+            scan_directory(folder, matcher, True, self.args.root_dir, ignore_rules, project_structure)
+        snapshot = {}
+        for files in project_structure.values():
+            for file_path in files:
+                try:
+                    snapshot[file_path] = file_stat_signature(file_path)
+                except OSError:
+                    pass
+        return snapshot
+
+    def wait_for_changes(self, timeout: Optional[float]) -> Optional[set]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.monotonic())))
+            snapshot = self.take_snapshot()
+            changed = {path for path in snapshot.keys() | self.snapshot.keys()
+                       if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+class InotifyWatcher(FileWatcher):
+    """Linux inotify watches on every folder of the project, added through ctypes."""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, args: argparse.Namespace):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.args = args
+        self.ignore_rules = load_ignore_rules(args.root_dir, args.exclude, not args.no_gitignore)
+        self.watches = {}  # watch descriptor -> (folder, recursive)
+        self.add_watch(args.root_dir, False)
+        for folder in args.folders:
+            self.add_watches_recursively(folder)
+
+    def add_watch(self, folder: str, recursive: bool):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+        # The root folder is watched non-recursively, but may also be one of the recursive folders
+        recursive = recursive or self.watches.get(wd, (folder, False))[1]
+        self.watches[wd] = (folder, recursive)
+
+    def add_watches_recursively(self, folder: str) -> set:
+        """Watches a folder and all of its subfolders. Returns the files already in them."""
+        files = set()
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            self.add_watch(current, True)
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        relative_path = relative_to_root(entry.path, self.args.root_dir)
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if self.ignore_rules and self.ignore_rules.is_ignored(relative_path, is_dir):
+                            continue
+                        if is_dir:
+                            stack.append(entry.path)
+                        else:
+                            files.add(entry.path)
+            except OSError:
+                continue
+        return files
+
+    def wait_for_changes(self, timeout: Optional[float]) -> Optional[set]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches or not name:
+                continue
+            folder, recursive = self.watches[wd]
+            path = os.path.join(folder, name)
+            if mask & self.IN_ISDIR:
+                if recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    changed |= self.add_watches_recursively(path)
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    # Files in a removed folder are not reported one by one
+                    return None
+            else:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_file_watcher(args: argparse.Namespace) -> FileWatcher:
+    """Uses inotify where available and falls back to polling."""
+    if not args.polling and sys.platform.startswith("linux"):
+        try:
+            watcher = InotifyWatcher(args)
+            logger.info("Watching for changes with inotify...")
+            return watcher
+        except (OSError, AttributeError) as error:
+            logger.warning(f"inotify is not available ({error}). Falling back to polling...")
+    logger.info(f"Watching for changes by polling every {args.poll_interval}s...")
+    return PollingWatcher(args, args.poll_interval)
+
+
+def wait_for_debounced_changes(watcher: FileWatcher, debounce: float) -> Optional[set]:
+    """Waits for changes and collects further changes until none arrived for `debounce` seconds."""
+    changes = set()
+    rescan = False
+    timeout = None
+    while True:
+        new_changes = watcher.wait_for_changes(timeout)
+        if new_changes is None:
+            rescan = True
+        elif new_changes:
+            changes |= new_changes
+        elif timeout is not None:
+            break
+        timeout = debounce
+    return None if rescan else changes
+
+
+def watch(args: argparse.Namespace):
+    """Documents the project once and then keeps the README up to date while files change.
+
+    The component index stays in memory. Changed files only re-summarize the components they belong to (through
+    the cache), added or removed files rebuild the index, and the README is patched section by section.
+    Deduplication runs on every update, but only files that changed are read again. An update that fails is
+    logged and the whole project is checked again on the next change.
+    """
+    configure_backend(create_backend(args), args.model)
+    configure_rate_limiter(args.max_concurrency, args.requests_per_minute, args.tokens_per_minute)
+    configure_preprocessing(not args.no_preprocess, args.max_body_tokens)
+    stats = reset_run_stats()
+    matcher = FileTypeMatcher(FILE_TYPES)
+
+    logger.info("Loading intermediate results...")
+    results = load_intermediate_results(args.results_backend, args.results_file)
+    watcher = None
+    try:
+        fingerprints = FileFingerprints(results)
+        project_structure, component_index, summaries, duplicates = {}, {}, {}, {}
+        project_context = None
+        resync = False
+        try:
+            project_structure, component_index = discover_project(args)
+            project_context = ProjectContext(project_structure, args.root_dir, args.context_mode)
+            components = list(component_index.items())
+            representatives, duplicates = find_duplicates(args, components, fingerprints)
+            summaries, _ = summarize_components(representatives, results, project_context, args.max_concurrency,
+                                                args.max_prompt_tokens)
+            summaries.update(duplicate_summaries(components, duplicates, summaries))
+            update_readme(args, results, project_structure, summaries)
+        except Exception:
+            logger.exception("Documenting the project failed. Everything is checked again on the next change.")
+            resync = True
+        report_run(args, stats)
+
+        watcher = create_file_watcher(args)
+        logger.info("Press Ctrl+C to stop watching.")
+        while True:
+            changes = wait_for_debounced_changes(watcher, args.debounce)
+            if changes is not None:
+                changes = {path for path in changes if matcher.matches(os.path.basename(path))}
+                if not changes:
+                    continue
+            if resync:
+                # The last update failed halfway, so the index and summaries may be out of date anywhere
+                changes = None
+            start = time.monotonic()
+            try:
+                known_files = {file_path for files in component_index.values() for file_path in files}
+                if changes is None or any(path not in known_files or not os.path.exists(path) for path in changes):
+                    logger.info("Rebuilding the component index..." if changes is None else
+                                "Files were added or removed. Rebuilding the component index...")
+                    previous_index = component_index
+                    project_structure, component_index = discover_project(args)
+                    project_context = ProjectContext(project_structure, args.root_dir, args.context_mode)
+                    affected = [name for name, files in component_index.items()
+                                if changes is None or previous_index.get(name) != files or set(files) & changes]
+                    for name in set(summaries) - set(component_index):
+                        del summaries[name]
+                else:
+                    affected = [name for name, files in component_index.items() if set(files) & changes]
+
+                logger.info(f"{len(changes) if changes is not None else 'Unknown number of'} files changed, "
+                            f"updating {len(affected)} components...")
+                # Components that stopped being duplicates need a summary of their own
+                components = list(component_index.items())
+                previous_duplicates = duplicates
+                representatives, duplicates = find_duplicates(args, components, fingerprints)
+                pending = [(name, files) for name, files in representatives
+                           if name in affected or name in previous_duplicates or name not in summaries]
+                summaries.update(summarize_components(pending, results, project_context, args.max_concurrency,
+                                                      args.max_prompt_tokens)[0])
+                summaries.update(duplicate_summaries(components, duplicates, summaries))
+                update_readme(args, results, project_structure, summaries)
+                resync = False
+                logger.info(f"Documentation updated in {time.monotonic() - start:.1f}s.")
+            except Exception:
+                # E.g. an API error after all retries or a file that was removed or half-written while reading it
+                logger.exception("Updating the documentation failed. Everything is checked again on the next change.")
+                resync = True
+            # The report covers the whole session
+            report_run(args, stats)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
+    finally:
+        if watcher is not None:
+            watcher.close()
+        close_intermediate_results(results, args.compact_results)
+
+
+def configure_logging(level: str):
+    """Logs to stderr, with the time and level of every message."""
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)-7s %(message)s", datefmt="%H:%M:%S")
+
+
+def profiled(function: Callable, path: str) -> Callable:
+    """Wraps `function` in cProfile, saves the statistics to `path` and logs the most expensive functions.
+
+    cProfile only covers the thread it was enabled in, so every thread started during the run (e.g. the workers
+    that prepare and request summaries) gets a profiler of its own and their statistics are merged.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        profilers = [cProfile.Profile()]
+        lock = threading.Lock()
+
+        def profile_thread(*_):
+            # Called on the first event of a new thread, replaces itself with a profiler for that thread
+            sys.setprofile(None)
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Since Python 3.12 the first profiler already covers all threads and a second one can't be enabled
+                return
+            with lock:
+                profilers.append(profiler)
+
+        threading.setprofile(profile_thread)
+        try:
+            return profilers[0].runcall(function, *args, **kwargs)
+        finally:
+            threading.setprofile(None)
+            output = io.StringIO()
+            with lock:
+                stats = pstats.Stats(*profilers, stream=output)
+            stats.dump_stats(path)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            logger.info(f"Profile of {len(profilers)} threads saved to {path} "
+                        f"(view with `python -m pstats {path}`):\n{output.getvalue()}")
+    return wrapper
 
-    with open(readme_path, "w", encoding="utf-8") as readme_file:
-        readme_file.write(readme_content)
 
-    print(f"README.md has been generated at {readme_path}")
+def main():
+    argv = sys.argv[1:]
+    commands = {"run": run, "watch": watch, "merge": merge}
+    command = argv[0] if argv and argv[0] in commands and argv[0] != "run" else "run"
+    args = parse_args(argv[1:] if command != "run" else argv, command)
+    configure_logging(args.log_level)
+    function = commands[command]
+    if args.profile:
+        function = profiled(function, args.profile)
+    function(args)
 
 
 if __name__ == "__main__":
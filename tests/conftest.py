@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# main.py and benchmark.py are plain modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """Answers all requests with the fake backend, without rate limits, and counts them in fresh run statistics."""
+    backend = main.FakeBackend(latency=0)
+    monkeypatch.setattr(main, "backend", backend)
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(main.MAX_CONCURRENT_REQUESTS, 0, 0))
+    monkeypatch.setattr(main, "run_stats", main.RunStats())
+    return backend
@@ -0,0 +1,68 @@
+import os
+import threading
+
+import pytest
+
+import fake_openai_server
+import main
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    """Runs the fake OpenAI server and points the OpenAI backend at it, keeping the batch state in `tmp_path`."""
+    server = fake_openai_server.create_server(0, batch_delay=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    monkeypatch.setattr(main, "backend", main.OpenAIBackend(api_key="test"))
+    monkeypatch.setattr(main, "run_stats", main.RunStats())
+    monkeypatch.setattr(main, "BATCH_STATE_FILE", str(tmp_path / "batch_state.json"))
+    yield server.RequestHandlerClass.state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def project(tmp_path):
+    folder = tmp_path / "project"
+    folder.mkdir()
+    components = []
+    for name in ["alpha", "beta", "gamma"]:
+        (folder / f"{name}.cpp").write_text(f"int {name}() {{ return 1; }}\n", encoding="utf-8")
+        components.append((name, [str(folder / f"{name}.cpp")]))
+    results = main.JsonlResultsStore(str(tmp_path / "results.jsonl"))
+    yield components, results, main.ProjectContext({str(folder): [path for _, (path,) in components]}, str(folder))
+    results.close()
+
+
+def summarize_in_batches(project, tmp_path):
+    components, results, project_context = project
+    main.summarize_components_in_batches(components, results, project_context,
+                                         batch_dir=str(tmp_path / "batches"), poll_interval=0)
+
+
+def test_batch_summaries_reach_the_store(server, project, tmp_path):
+    summarize_in_batches(project, tmp_path)
+    components, results, _ = project
+    assert len(server.batches) == 1
+    for _, file_paths in components:
+        assert results["|".join(file_paths)]["summary"].startswith("## ")
+    assert main.run_stats.requests == 3
+    assert not os.path.exists(main.BATCH_STATE_FILE)
+
+    # Everything is cached now, so nothing is submitted again
+    summarize_in_batches(project, tmp_path)
+    assert len(server.batches) == 1
+
+
+def test_batches_of_an_interrupted_run_are_collected_not_resubmitted(server, project, tmp_path):
+    components, results, project_context = project
+    # An earlier run submitted the batch and stopped before collecting it
+    requests = [main.prepare_component_summary(file_paths, results, project_context)[1] for _, file_paths in components]
+    (path, custom_ids), = main.write_batch_files(requests, str(tmp_path / "batches"))
+    main.save_batch_state({main.submit_batch(path): custom_ids})
+
+    summarize_in_batches(project, tmp_path)
+    assert len(server.batches) == 1
+    assert all("|".join(file_paths) in results for _, file_paths in components)
+    assert not os.path.exists(main.BATCH_STATE_FILE)
@@ -0,0 +1,95 @@
+import os
+import shutil
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def component(tmp_path, fake_backend):
+    folder = tmp_path / "project" / "src"
+    folder.mkdir(parents=True)
+    for name, content in [("widget.h", "class Widget { int draw(); };\n"), ("widget.cpp", "int Widget::draw() { return 1; }\n")]:
+        (folder / name).write_text(content, encoding="utf-8")
+    file_paths = sorted(str(path) for path in folder.iterdir())
+    results = main.JsonlResultsStore(str(tmp_path / "results.jsonl"))
+    yield file_paths, results
+    results.close()
+
+
+def summarize(file_paths, results):
+    project_context = main.ProjectContext({os.path.dirname(file_paths[0]): file_paths}, os.path.dirname(file_paths[0]))
+    return main.prepare_component_summary(file_paths, results, project_context)
+
+
+def summarize_and_store(file_paths, results):
+    cached, request = summarize(file_paths, results)
+    assert cached is None
+    return main.store_component_summary(results, request, main.request_component_summary(request))
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    paths = []
+    read_file = main.read_file
+    monkeypatch.setattr(main, "read_file", lambda file_path: paths.append(file_path) or read_file(file_path))
+    return paths
+
+
+def test_unchanged_files_are_not_read(component, reads):
+    file_paths, results = component
+    summary = summarize_and_store(file_paths, results)
+    reads.clear()
+    assert summarize(file_paths, results) == (summary, None)
+    assert reads == []
+
+
+def test_touched_files_are_hashed_but_not_summarized(component, reads):
+    file_paths, results = component
+    summary = summarize_and_store(file_paths, results)
+    requests = main.run_stats.requests
+    stat = os.stat(file_paths[0])
+    os.utime(file_paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    reads.clear()
+    assert summarize(file_paths, results) == (summary, None)
+    assert sorted(reads) == file_paths
+    assert main.run_stats.requests == requests
+    # The new modification time is stored, so the next run doesn't read the files again
+    reads.clear()
+    assert summarize(file_paths, results) == (summary, None)
+    assert reads == []
+
+
+def test_changed_files_are_summarized_again(component):
+    file_paths, results = component
+    summarize_and_store(file_paths, results)
+    with open(file_paths[0], "a", encoding="utf-8") as file:
+        file.write("// changed\n")
+    cached, request = summarize(file_paths, results)
+    assert cached is None and request is not None
+
+
+def test_moved_components_reuse_their_summary(component, tmp_path):
+    file_paths, results = component
+    summary = summarize_and_store(file_paths, results)
+    # E.g. a fresh clone in another folder, or the project moved elsewhere
+    moved_folder = tmp_path / "clone" / "src"
+    shutil.copytree(os.path.dirname(file_paths[0]), moved_folder)
+    moved_paths = sorted(str(path) for path in moved_folder.iterdir())
+    assert summarize(moved_paths, results) == (summary, None)
+    assert results["|".join(moved_paths)]["summary"] == summary[0]
+
+
+def test_legacy_records_with_modification_times_are_accepted(component):
+    file_paths, results = component
+    results["|".join(file_paths)] = {
+        'summary': "## widget.cpp & widget.h\nLegacy summary.\n[Relevance score: 6]",
+        'relevance': 6.0,
+        'last_modified_times': [os.path.getmtime(file_path) for file_path in file_paths],
+    }
+    cached, request = summarize(file_paths, results)
+    assert request is None and cached[1] == 6.0
+    # The record is upgraded to the content-addressed format
+    assert results["|".join(file_paths)]["content_hash"]
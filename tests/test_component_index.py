@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import main
+
+
+def build_index(root_dir: str, folders: list, **kwargs) -> dict:
+    """Builds the component index of empty files, listing the folders in the given order."""
+    project_structure = {}
+    for folder, names in folders:
+        path = os.path.join(root_dir, folder)
+        os.makedirs(path, exist_ok=True)
+        project_structure[path] = [os.path.join(path, name) for name in names]
+        for file_path in project_structure[path]:
+            open(file_path, "w").close()
+    index = main.build_component_index(project_structure, root_dir, **kwargs)
+    return {name: [os.path.relpath(file_path, root_dir) for file_path in files] for name, files in index.items()}
+
+
+def test_pairs_with_rules_and_unique_stems(tmp_path):
+    index = build_index(str(tmp_path), [
+        ("include/gfx", ["foo.h", "bar.h"]),
+        ("src/gfx", ["foo.cpp"]),
+        ("lib", ["bar.cpp"]),
+    ])
+    assert index == {
+        "include/gfx/foo": ["include/gfx/foo.h", "src/gfx/foo.cpp"],
+        "include/gfx/bar": ["include/gfx/bar.h", "lib/bar.cpp"],
+    }
+
+
+def test_unique_stem_pairing_can_be_disabled(tmp_path):
+    index = build_index(str(tmp_path), [("include", ["bar.h"]), ("lib", ["bar.cpp"])], pair_unique_stems=False)
+    assert index == {"include/bar.h": ["include/bar.h"], "lib/bar.cpp": ["lib/bar.cpp"]}
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_stems_paired_by_rules_are_not_unique(tmp_path, reverse):
+    folders = [
+        ("include/a", ["foo.h"]),
+        ("src/a", ["foo.cpp"]),
+        ("x", ["foo.h"]),
+        ("y", ["foo.cpp"]),
+    ]
+    index = build_index(str(tmp_path), folders[::-1] if reverse else folders)
+    assert index == {
+        "include/a/foo": ["include/a/foo.h", "src/a/foo.cpp"],
+        "x/foo.h": ["x/foo.h"],
+        "y/foo.cpp": ["y/foo.cpp"],
+    }
+
+
+def test_pairing_order_does_not_depend_on_hashing():
+    files = [f"src/{name}" for name in ["zeta.h", "zeta.cpp", "alpha.cpp", "mid.h", "alpha.h", "beta.cpp"]]
+    paired_files = main.pair_header_and_source_files(files)
+    assert [name for name in paired_files if not name.startswith("unpaired")] == ["alpha", "zeta"]
+    assert paired_files["unpaired_files"] == ["src/beta.cpp", "src/mid.h"]
+
+
+def test_relevance_ties_are_ranked_by_name():
+    summaries = {"b": ("B", 5.0), "c": ("C", 9.0), "a": ("A", 5.0)}
+    assert [name for name, _ in main.rank_by_relevance(summaries)] == ["c", "a", "b"]
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+import main
+
+CLASS_TEMPLATE = """class {name} {{
+public:
+    int compute(int value) const {{ return value * {factor} + offset_; }}
+    int reset() {{ offset_ = 0; return offset_; }}
+    void configure(int offset, int scale, const char* label) {{ offset_ = offset; scale_ = scale; label_ = label; }}
+private:
+    int offset_ = 0;
+    int scale_ = 1;
+    const char* label_ = "{name}";
+}};
+"""
+
+
+def write_components(root_dir: str) -> list:
+    components = []
+    for folder, factor in [("a", 2), ("b", 2), ("c", 3)]:
+        path = os.path.join(root_dir, folder, "widget.h")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(CLASS_TEMPLATE.format(name="Widget", factor=factor))
+        components.append((f"{folder}/widget", [path]))
+    return components
+
+
+def test_finds_identical_and_near_duplicates(tmp_path):
+    components = write_components(str(tmp_path))
+    representatives, duplicates = main.deduplicate_components(components, str(tmp_path))
+    assert [name for name, _ in representatives] == ["a/widget"]
+    assert duplicates["b/widget"]["similarity"] == 1.0
+    assert duplicates["c/widget"]["representative"] == "a/widget"
+    assert "-    int compute(int value) const { return value * 2" in duplicates["c/widget"]["note"]
+
+
+def test_stored_fingerprints_skip_unchanged_files(tmp_path, monkeypatch):
+    components = write_components(str(tmp_path))
+    path = str(tmp_path / "results.jsonl")
+    results = main.JsonlResultsStore(path)
+    _, expected = main.deduplicate_components(components, str(tmp_path), main.FileFingerprints(results))
+    results.close()
+
+    read_paths = []
+    read_file = main.read_file
+    monkeypatch.setattr(main, "read_file", lambda file_path: read_paths.append(file_path) or read_file(file_path))
+    results = main.JsonlResultsStore(path)
+    _, duplicates = main.deduplicate_components(components, str(tmp_path), main.FileFingerprints(results))
+    assert duplicates == expected
+    assert read_paths == []
+
+    # A changed file is read again, as is the diff against it
+    changed_path = components[2][1][0]
+    with open(changed_path, "a", encoding="utf-8") as file:
+        file.write("// changed\n")
+    _, duplicates = main.deduplicate_components(components, str(tmp_path), main.FileFingerprints(results))
+    assert "+// changed" in duplicates["c/widget"]["note"]
+    assert changed_path in read_paths and components[1][1][0] not in read_paths
+    results.close()
+
+
+@pytest.mark.parametrize("threshold", ["0", "-0.5", "1.5"])
+def test_near_duplicate_threshold_is_validated(tmp_path, threshold):
+    with pytest.raises(SystemExit):
+        main.parse_args([str(tmp_path), "src", "--near-duplicate-threshold", threshold])
+
+
+def test_concurrency_limit_applies_to_fingerprinting(tmp_path, monkeypatch):
+    pool_sizes = []
+    executor = main.ThreadPoolExecutor
+    monkeypatch.setattr(main, "ThreadPoolExecutor",
+                        lambda max_workers: pool_sizes.append(max_workers) or executor(max_workers=max_workers))
+    args = main.parse_args([str(tmp_path), "src", "--max-concurrency", "3", "--near-duplicate-threshold", "1"])
+    main.find_duplicates(args, write_components(str(tmp_path)))
+    assert pool_sizes == [3]
@@ -0,0 +1,103 @@
+import main
+
+LONG_BODY = "".join(f"    total += step({index});\n" for index in range(12))
+
+
+def elide(content: str, max_tokens: int = 20) -> str:
+    return main.elide_large_blocks(content, max_tokens)
+
+
+def test_function_bodies_are_cut_and_signatures_kept():
+    content = f"int sum(int count) const {{\n{LONG_BODY}    return total;\n}}\n\nint small() {{ return 1; }}\n"
+    elided = elide(content)
+    assert elided.startswith("int sum(int count) const {\n    total += step(0);\n")
+    assert "/* ... " in elided and "return total;" not in elided
+    assert elided.endswith("}\n\nint small() { return 1; }\n")
+
+
+def test_constructor_with_braced_member_initializers():
+    content = (f"Widget::Widget(int size) : size_{{size}}, items_{{}}, name_(\"widget\") {{\n{LONG_BODY}}}\n"
+               f"Widget::Widget() noexcept : Widget{{0}} {{\n{LONG_BODY}}}\n")
+    elided = elide(content)
+    assert 'Widget::Widget(int size) : size_{size}, items_{}, name_("widget") {\n' in elided
+    assert "Widget::Widget() noexcept : Widget{0} {\n" in elided
+    assert elided.count("/* ... ") == 2
+    assert main.find_elidable_blocks(content)[0][0] == content.index(") {") + 2
+
+
+def test_lambda_bodies():
+    content = f"auto handler = [this](int value) {{\n{LONG_BODY}}};\nstd::sort(a, b, [](int x, int y) {{ return x < y; }});\n"
+    elided = elide(content)
+    assert elided.startswith("auto handler = [this](int value) {\n")
+    assert "/* ... " in elided
+    assert elided.endswith("};\nstd::sort(a, b, [](int x, int y) { return x < y; });\n")
+
+
+def test_extern_c_and_namespaces_are_entered():
+    content = f'extern "C" {{\nnamespace gfx {{\nint draw(int mode) {{\n{LONG_BODY}}}\nint declared(int mode);\n}}\n}}\n'
+    elided = elide(content)
+    assert elided.startswith('extern "C" {\nnamespace gfx {\nint draw(int mode) {\n')
+    assert "/* ... " in elided
+    assert elided.endswith("}\nint declared(int mode);\n}\n}\n")
+
+
+def test_classes_and_enums_are_kept_whole():
+    members = "".join(f"    int member{index}(int value) const;\n" for index in range(12))
+    values = "".join(f"    Value{index},\n" for index in range(30))
+    content = (f"class Widget : public Base {{\npublic:\n{members}}};\n"
+               f"enum class Mode : int {{\n{values}}};\n"
+               f"struct Point {{ int x; int y; }};\n")
+    assert elide(content) == content
+
+
+def test_initializers_after_assignment_are_cut():
+    values = "".join(f"    {index}, {index * 2}, {index * 3},\n" for index in range(20))
+    content = f"static const int table[] = {{\n{values}}};\nint after = 1;\n"
+    elided = elide(content)
+    assert "/* ... " in elided and elided.endswith("};\nint after = 1;\n")
+
+
+def test_braces_in_comments_and_strings_are_ignored():
+    content = (
+        "// a stray { in a comment\n"
+        "/* and } in a block comment { */\n"
+        f"const char* json() {{\n    const char* raw = R\"x({{\"open\": {{)x\";\n"
+        f"    const char* text = \"}} {{\";\n    char brace = '{{';\n{LONG_BODY}}}\n"
+        "int after(int value) { return value; }\n"
+    )
+    blocks = main.find_elidable_blocks(content)
+    assert len(blocks) == 2
+    assert content[blocks[0][1]:].startswith("}\nint after")
+    assert elide(content).endswith("}\nint after(int value) { return value; }\n")
+
+
+def test_preprocessor_lines_are_ignored():
+    content = f"#define OPEN {{\n#if FEATURE\nint feature() {{\n{LONG_BODY}}}\n#endif\n"
+    elided = elide(content)
+    assert elided.startswith("#define OPEN {\n#if FEATURE\nint feature() {\n")
+    assert elided.endswith("}\n#endif\n")
+
+
+def test_license_banners_are_stripped():
+    content = ("/*\n * Copyright (c) 2024 Someone\n * Licensed under the MIT License.\n */\n"
+               "// SPDX-License-Identifier: MIT\n\n#pragma once\n")
+    assert main.strip_license_banner(content) == "#pragma once\n"
+    cmake = "# Copyright 2024 Someone\n# All rights reserved.\ncmake_minimum_required(VERSION 3.20)\n"
+    assert main.strip_license_banner(cmake, "#") == "cmake_minimum_required(VERSION 3.20)\n"
+
+
+def test_comments_without_a_license_are_kept():
+    content = "/* Widget utilities: drawing and layout. */\n#pragma once\n"
+    assert main.strip_license_banner(content) == content
+    content = "// Copyright 2024 Someone\n\n// Draws widgets.\nint draw();\n"
+    assert main.strip_license_banner(content) == "// Draws widgets.\nint draw();\n"
+
+
+def test_preprocess_source(monkeypatch):
+    monkeypatch.setattr(main, "MAX_BODY_TOKENS", 20)
+    content = f"// Copyright 2024 Someone\n\n\n\nint sum() {{   \n{LONG_BODY}}}\n\n\n"
+    preprocessed = main.preprocess_source("sum.cpp", content)
+    assert preprocessed.startswith("int sum() {\n    total += step(0);\n")
+    assert "/* ... " in preprocessed and preprocessed.endswith("}\n")
+    # CMake files only lose banners and blank lines
+    assert main.preprocess_source("CMakeLists.txt", "# License: MIT\n\n\nproject(demo)\n\n\n") == "project(demo)\n"
@@ -0,0 +1,139 @@
+import threading
+import time
+
+import httpx
+import pytest
+from openai import APIStatusError, BadRequestError, RateLimitError
+
+import main
+
+
+def api_error(error_class, status_code: int, headers: dict = None) -> Exception:
+    request = httpx.Request("POST", "https://api.example.com/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    return error_class(f"status {status_code}", response=response, body=None)
+
+
+class FlakyBackend(main.LLMBackend):
+    """Raises the given errors on the first requests, then answers like the fake backend."""
+
+    def __init__(self, errors: list):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def complete(self, messages, model):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return main.FakeBackend(latency=0).complete(messages, model)
+
+
+@pytest.fixture
+def sleeps(fake_backend, monkeypatch):
+    delays = []
+    monkeypatch.setattr(main.time, "sleep", delays.append)
+    return delays
+
+
+MESSAGES = [{"role": "user", "content": "Summarize main.cpp"}]
+
+
+def test_rate_limits_and_server_errors_are_retried(monkeypatch, sleeps):
+    backend = FlakyBackend([api_error(RateLimitError, 429), api_error(APIStatusError, 503)])
+    monkeypatch.setattr(main, "backend", backend)
+    response = main.create_chat_completion(MESSAGES, "main.cpp")
+    assert response.content
+    assert backend.calls == 3
+    assert len(sleeps) == 2
+    assert main.run_stats.requests == 1
+
+
+def test_client_errors_are_not_retried(monkeypatch, sleeps):
+    backend = FlakyBackend([api_error(BadRequestError, 400)])
+    monkeypatch.setattr(main, "backend", backend)
+    with pytest.raises(BadRequestError):
+        main.create_chat_completion(MESSAGES)
+    assert backend.calls == 1
+    assert sleeps == []
+
+
+def test_retries_give_up_after_max_retries(monkeypatch, sleeps):
+    backend = FlakyBackend([api_error(APIStatusError, 500)] * (main.MAX_RETRIES + 1))
+    monkeypatch.setattr(main, "backend", backend)
+    with pytest.raises(APIStatusError):
+        main.create_chat_completion(MESSAGES)
+    assert backend.calls == main.MAX_RETRIES + 1
+    assert len(sleeps) == main.MAX_RETRIES
+
+
+def test_retry_after_is_honoured(monkeypatch, sleeps):
+    backend = FlakyBackend([api_error(RateLimitError, 429, {"retry-after": "7"})])
+    monkeypatch.setattr(main, "backend", backend)
+    main.create_chat_completion(MESSAGES)
+    assert 7 <= sleeps[0] <= 7 + main.RETRY_BASE_DELAY
+
+
+def test_backoff_grows_exponentially_up_to_the_maximum(monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: high)
+    error = api_error(APIStatusError, 502)
+    assert [main.retry_delay(error, attempt) for attempt in range(3)] == [1.0, 2.0, 4.0]
+    assert main.retry_delay(error, 20) == main.RETRY_MAX_DELAY
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def test_token_bucket_waits_for_refill(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(main.time, "sleep", clock.sleep)
+    bucket = main.TokenBucket(60)  # one token per second
+    bucket.acquire(60)
+    assert clock.now == 0
+    bucket.acquire(3)
+    assert clock.now == pytest.approx(3)
+    # Requests larger than the bucket wait for a full bucket instead of forever
+    bucket.acquire(1000)
+    assert clock.now == pytest.approx(63)
+
+
+def test_reported_usage_corrects_the_token_bucket(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock.monotonic)
+    limiter = main.RateLimiter(4, 0, 600)
+    with limiter.slot(100):
+        pass
+    limiter.record_usage(100, 300)
+    assert limiter.tokens.tokens == pytest.approx(300)
+    assert limiter.requests is None
+
+
+def test_in_flight_requests_are_bounded():
+    limiter = main.RateLimiter(2, 0, 0)
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def request():
+        with limiter.slot(10):
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
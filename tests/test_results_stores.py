@@ -0,0 +1,141 @@
+import json
+
+import pytest
+
+import main
+
+
+def record(summary: str) -> dict:
+    return {"summary": summary, "relevance": 5.0, "content_hash": main.hash_text(summary)}
+
+
+def open_store(path) -> main.JsonlResultsStore:
+    return main.JsonlResultsStore(str(path))
+
+
+@pytest.mark.parametrize("backend", sorted(main.RESULTS_STORES))
+def test_records_survive_reopening(tmp_path, backend):
+    path = str(tmp_path / f"results.{backend}")
+    results = main.RESULTS_STORES[backend](path)
+    results["a"] = record("first")
+    results["b"] = record("second")
+    results["a"] = record("updated")
+    del results["b"]
+    results.close()
+
+    results = main.RESULTS_STORES[backend](path)
+    assert dict(results) == {"a": record("updated")}
+    assert results.find_by_content_hash(main.hash_text("updated")) == record("updated")
+    results.close()
+
+
+def test_jsonl_drops_cut_off_last_line(tmp_path):
+    path = tmp_path / "results.jsonl"
+    results = open_store(path)
+    results["a"] = record("first")
+    results.close()
+    complete_size = path.stat().st_size
+    with open(path, "ab") as file:
+        file.write(b'"b"\t{"summary": "cut o')
+
+    results = open_store(path)
+    assert dict(results) == {"a": record("first")}
+    assert path.stat().st_size == complete_size
+    # New records are appended after the last complete line
+    results["b"] = record("second")
+    results.close()
+    assert dict(open_store(path)) == {"a": record("first"), "b": record("second")}
+
+
+def test_jsonl_skips_corrupt_lines_and_keeps_the_rest(tmp_path):
+    path = tmp_path / "results.jsonl"
+    results = open_store(path)
+    for key in "abc":
+        results[key] = record(key)
+    results.close()
+    lines = path.read_bytes().splitlines(keepends=True)
+    lines[1] = b'"unterminated\t{}\n'
+    path.write_bytes(b"".join(lines))
+
+    results = open_store(path)
+    assert dict(results) == {"a": record("a"), "c": record("c")}
+    # The corrupt line is kept until the next compaction removes it
+    assert results.line_count == 3
+    results.compact()
+    assert len(path.read_bytes().splitlines()) == 2
+    results.close()
+    assert dict(open_store(path)) == {"a": record("a"), "c": record("c")}
+
+
+def test_jsonl_skips_corrupt_values(tmp_path):
+    path = tmp_path / "results.jsonl"
+    results = open_store(path)
+    results["a"] = record("first")
+    results["a"] = record("second")
+    results["b"] = record("b")
+    results.close()
+    lines = path.read_bytes().splitlines(keepends=True)
+    lines[1] = b'"a"\t{"summary": "sec\xff\n'
+    lines[2] = b'"b"\t[1, 2]\n'
+    path.write_bytes(b"".join(lines))
+
+    # The last valid record of a key wins
+    results = open_store(path)
+    assert dict(results) == {"a": record("first")}
+    assert results.needs_compaction()
+    results.close()
+
+
+def test_jsonl_delete_markers(tmp_path):
+    path = tmp_path / "results.jsonl"
+    results = open_store(path)
+    results["a"] = record("first")
+    results["b"] = record("second")
+    del results["a"]
+    assert "a" not in results
+    with pytest.raises(KeyError):
+        results["a"]
+    results.close()
+
+    lines = path.read_bytes().splitlines()
+    assert lines[-1] == b'"a"\tnull'
+    results = open_store(path)
+    assert dict(results) == {"b": record("second")}
+    # A key can be stored again after it was deleted
+    results["a"] = record("again")
+    results.close()
+    assert dict(open_store(path)) == {"a": record("again"), "b": record("second")}
+
+
+def test_jsonl_compaction_rebuilds_the_index(tmp_path):
+    path = tmp_path / "results.jsonl"
+    results = open_store(path)
+    for version in range(3):
+        results["a"] = record(f"a{version}")
+        results["b"] = record(f"b{version}")
+    results["c"] = record("c")
+    del results["c"]
+    assert results.needs_compaction()
+
+    results.compact()
+    assert not results.needs_compaction()
+    assert dict(results) == {"a": record("a2"), "b": record("b2")}
+    lines = path.read_bytes().splitlines()
+    assert [json.loads(line.partition(b"\t")[0]) for line in lines] == ["a", "b"]
+
+    # The index points into the rewritten file, also for records appended afterwards
+    results["b"] = record("b3")
+    results["d"] = record("d")
+    assert results["a"] == record("a2")
+    assert results["b"] == record("b3")
+    results.close()
+    assert dict(open_store(path)) == {"a": record("a2"), "b": record("b3"), "d": record("d")}
+
+
+def test_close_intermediate_results_compacts_on_request(tmp_path):
+    path = tmp_path / "results.jsonl"
+    results = main.load_intermediate_results("jsonl", str(path))
+    for version in range(3):
+        results["a"] = record(f"a{version}")
+    main.close_intermediate_results(results, compact=True)
+    assert len(path.read_bytes().splitlines()) == 1
@@ -0,0 +1,37 @@
+import os
+
+import main
+
+
+def test_directory_outline_counts_files_per_directory(tmp_path):
+    root_dir = str(tmp_path)
+    project_structure = {
+        root_dir: [os.path.join(root_dir, "CMakeLists.txt")],
+        os.path.join(root_dir, "src", "gfx"): [os.path.join(root_dir, "src", "gfx", name) for name in ("a.h", "a.cpp")],
+    }
+    assert main.directory_outline(project_structure, root_dir) == "./ (3 files)\n  src/ (2 files)\n    gfx/ (2 files)"
+    shallow = "./ (3 files)\n  src/ (2 files)"
+    assert main.directory_outline(project_structure, root_dir, main.estimate_tokens(shallow)) == shallow
+
+
+def test_directory_outline_of_an_empty_project(tmp_path):
+    assert main.directory_outline({}, str(tmp_path)) == "./ (0 files)"
+
+
+def test_the_final_prompt_shares_the_budget_between_overview_and_file_tree(tmp_path, fake_backend, monkeypatch):
+    root_dir = str(tmp_path)
+    project_structure = {os.path.join(root_dir, "src", f"module{index}"): [] for index in range(40)}
+    description = " ".join(f"detail{index}" for index in range(40))
+    summaries = {f"src/part{index}": (f"## part{index}.cpp\n### Overview\nPart {index}: {description}\n", float(index))
+                 for index in range(12)}
+    prompts = []
+    complete = fake_backend.complete
+    monkeypatch.setattr(fake_backend, "complete", lambda messages, model: prompts.append(messages[-1]["content"])
+                        or complete(messages, model))
+    args = main.parse_args([root_dir, "src", "--overview-mode", "rollup", "--rollup-tokens", "600"])
+    results = main.JsonlResultsStore(str(tmp_path / "results.jsonl"))
+    main.update_readme(args, results, project_structure, summaries)
+    results.close()
+    final_prompt, = prompts
+    assert "- part11: Part 11" in final_prompt and "src/ (0 files)" in final_prompt
+    assert main.estimate_tokens(final_prompt) <= 600
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def project(tmp_path, fake_backend):
+    components = []
+    for name in ["alpha.cpp", "main.cpp", "beta_test.cpp", "gamma.cpp"]:
+        path = tmp_path / name
+        path.write_text(f"int {name.split('.')[0]}() {{ return 0; }} // main\n", encoding="utf-8")
+        components.append((name, [str(path)]))
+    project_structure = {str(tmp_path): [files[0] for _, files in components]}
+    results = main.JsonlResultsStore(str(tmp_path / "results.jsonl"))
+    yield components, results, main.ProjectContext(project_structure, str(tmp_path))
+    results.close()
+
+
+@pytest.fixture
+def requested(monkeypatch):
+    """Lists the keys of the components whose summaries are requested, in order."""
+    names = []
+    request_component_summary = main.request_component_summary
+    monkeypatch.setattr(main, "request_component_summary",
+                        lambda request, *args: names.append(request['file_key']) or request_component_summary(request, *args))
+    return names
+
+
+def test_pending_components_are_requested_by_predicted_relevance(project, requested):
+    components, results, project_context = project
+    main.summarize_components(components, results, project_context, 1)
+    assert [os.path.basename(name) for name in requested] == ["main.cpp", "alpha.cpp", "gamma.cpp", "beta_test.cpp"]
+
+
+def test_summaries_follow_the_order_of_the_components(project):
+    components, results, project_context = project
+    main.summarize_components(components[1:2], results, project_context, 1)
+    summaries, stale = main.summarize_components(components, results, project_context, 1)
+    assert list(summaries) == [name for name, _ in components]
+    assert stale == set()
+
+
+def test_exhausted_budget_keeps_previous_summaries(project, requested):
+    components, results, project_context = project
+    previous, _ = main.summarize_components(components, results, project_context, 1)
+    for _, files in components:
+        with open(files[0], "a", encoding="utf-8") as file:
+            file.write("// changed\n")
+
+    requested.clear()
+    summaries, stale = main.summarize_components(components, results, project_context, 1, budget=main.Budget(max_tokens=1))
+    assert requested == []
+    assert summaries == previous
+    assert stale == {name for name, _ in components}
+    assert main.run_stats.as_dict()["budget_exhausted"] == "tokens"
+
+    section = main.render_readme_section("main.cpp", summaries["main.cpp"][0], stale=True)
+    assert main.STALE_SECTION_NOTE in section
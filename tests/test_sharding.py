@@ -0,0 +1,100 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def component(tmp_path, fake_backend):
+    folder = tmp_path / "project"
+    folder.mkdir()
+    (folder / "widget.h").write_text("class Widget {};\n", encoding="utf-8")
+    (folder / "widget.cpp").write_text("#include \"widget.h\"\n", encoding="utf-8")
+    return "widget", sorted(str(path) for path in folder.iterdir())
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    paths = []
+    read_file = main.read_file
+    monkeypatch.setattr(main, "read_file", lambda file_path: paths.append(file_path) or read_file(file_path))
+    return paths
+
+
+def summarize_into(path, file_paths) -> dict:
+    """Summarizes the component into a new shard results file and returns the stored record."""
+    results = main.JsonlResultsStore(str(path))
+    project_context = main.ProjectContext({}, str(path.parent))
+    _, request = main.prepare_component_summary(file_paths, results, project_context)
+    main.store_component_summary(results, request, main.request_component_summary(request))
+    record = results["|".join(file_paths)]
+    results.close()
+    return record
+
+
+def write_shard(path, records: dict):
+    results = main.JsonlResultsStore(str(path))
+    results.put_many(records)
+    results.close()
+
+
+def test_shards_are_stable_and_cover_all_components():
+    names = [f"src/component{index}" for index in range(200)]
+    shards = [main.shard_of(name, 4) for name in names]
+    assert set(shards) == {1, 2, 3, 4}
+    # Derived from SHA-256, so every machine (and every hash seed) assigns the same shard
+    assert [main.shard_of(name, 4) for name in ["main", "include/gfx/foo", "src/app"]] == [4, 2, 2]
+    assert all(main.shard_of(name, 1) == 1 for name in names)
+
+
+def test_record_preference_prefers_current_content_then_newest():
+    current = {'content_hash': "current", 'updated_at': "2024-01-01T00:00:00+00:00"}
+    newer = {'content_hash': "old", 'updated_at': "2025-01-01T00:00:00+00:00"}
+    newest_files = {'content_hash': "old", 'updated_at': "2025-01-01T00:00:00+00:00",
+                    'files': [{'path': "a.cpp", 'size': 1, 'mtime_ns': 5, 'sha256': "x"}]}
+    ranked = sorted([newer, newest_files, current], key=lambda record: main.record_preference(record, {"current"}))
+    assert ranked == [newer, newest_files, current]
+
+
+def test_merge_keeps_the_record_of_the_current_files(tmp_path, component, reads):
+    _, file_paths = component
+    key = "|".join(file_paths)
+    current = summarize_into(tmp_path / "shard-1.jsonl", file_paths)
+    write_shard(tmp_path / "shard-1.jsonl", {key: {**current, 'updated_at': "2020-01-01T00:00:00+00:00"},
+                                             "other": {'summary': "older", 'content_hash': "a",
+                                                       'updated_at': "2024-01-01T00:00:00+00:00"}})
+    write_shard(tmp_path / "shard-2.jsonl", {key: {**current, 'summary': "stale", 'content_hash': "stale",
+                                                   'updated_at': "2030-01-01T00:00:00+00:00"},
+                                             "other": {'summary': "newer", 'content_hash': "b",
+                                                       'updated_at': "2025-01-01T00:00:00+00:00"}})
+
+    reads.clear()
+    results = main.JsonlResultsStore(str(tmp_path / "results.jsonl"))
+    paths = [str(tmp_path / "shard-1.jsonl"), str(tmp_path / "shard-2.jsonl")]
+    assert main.merge_intermediate_results(paths, results, [component]) == 2
+    assert results[key]['summary'] == current['summary']
+    assert results["other"]['summary'] == "newer"
+    # The hashes of the current files come from the stored sizes and modification times
+    assert reads == []
+    results.close()
+
+
+def test_current_content_hashes_use_stored_fingerprints(tmp_path, component, reads):
+    _, file_paths = component
+    expected = main.current_content_hashes([component], [])
+    assert sorted(reads) == file_paths
+
+    results = main.JsonlResultsStore(str(tmp_path / "results.jsonl"))
+    fingerprints = main.FileFingerprints(results)
+    for file_path in file_paths:
+        fingerprints.get(file_path)
+    fingerprints.save()
+    reads.clear()
+    assert main.current_content_hashes([component], [results]) == expected
+    assert reads == []
+
+    # A changed file is read again
+    with open(file_paths[0], "a", encoding="utf-8") as file:
+        file.write("// changed\n")
+    assert main.current_content_hashes([component], [results]) != expected
+    assert reads == [file_paths[0]]
+    results.close()